@@ -14,11 +14,12 @@ setup(
     url='curlba.sh/jhartog/sobchak',
     long_description_content_type='text/markdown',
     packages=find_packages(),
-    scripts=['scripts/sobchak'],
+    scripts=['scripts/sobchak', 'scripts/sobchak-benchmark'],
     install_requires=[
         'python-keystoneclient',
         'python-novaclient',
         'matplotlib',
+        'numpy',
     ],
 )
 
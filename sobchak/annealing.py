@@ -0,0 +1,255 @@
+import logging
+import math
+import random
+import time
+from sobchak.migration import Migration
+
+# Default number of moves proposed per run
+STEPS = 100000
+
+# Default cost of every VM which is moved away from its hypervisor, relative to
+# the average score of the hypervisors
+MIGRATION_COST = 0.1
+
+# Default maximum number of moved VMs, as a fraction of all VMs
+MAX_MOVED = 0.1
+
+# Chance that a proposal moves a VM which was moved before back to its own
+# hypervisor
+RETURN_CHANCE = 0.1
+
+class Annealer(object):
+    """Annealer
+
+    An Annealer object searches for a better distribution of VMs over all
+    enabled hypervisors at once by simulated annealing, instead of mixing a
+    single pair of hypervisors. Every step proposes to move a random VM to
+    another hypervisor or to swap two VMs of different hypervisors. Only the
+    two hypervisors involved change, so the change of the total score is
+    calculated in constant time from their used resources.
+
+    Moves which lower the total score (plus a cost for every VM which is not on
+    its current hypervisor anymore; `migration_cost` times the average score of
+    the hypervisors when the search starts) are always accepted,
+    other moves with a probability which decreases with the temperature. As
+    sequences of moves are explored, exchanges between three or more
+    hypervisors are found as well. The hypervisors themselves are left alone;
+    the result is a list of the needed migrations.
+    """
+
+    def __init__(self, hypervisors, seed=None, migration_cost=MIGRATION_COST,
+                 subject_ids=None):
+        self._hypervisors = [h for h in hypervisors if h.enabled]
+        self._random = random.Random(seed)
+        self._subjects = None
+        if subject_ids is not None:
+            self._subjects = set([i for i, h in enumerate(self._hypervisors)
+                                  if h.id in subject_ids])
+
+        self._vms = []
+        self._origins = []
+        for i, hypervisor in enumerate(self._hypervisors):
+            for vm in hypervisor.servers:
+                self._vms.append(vm)
+                self._origins.append(i)
+        self._locations = list(self._origins)
+        self._used_ram = [h.used_ram for h in self._hypervisors]
+        self._used_vcpus = [h.used_vcpus for h in self._hypervisors]
+        self._scores = [abs(h.score) for h in self._hypervisors]
+        self._migration_cost = 0
+        if self._scores:
+            self._migration_cost = migration_cost * sum(self._scores) / \
+                len(self._scores)
+
+        # The VMs which are not on their own hypervisor, in a list (so a random
+        # one can be picked) and by their position in that list
+        self._displaced = []
+        self._displaced_positions = {}
+
+    def _score(self, i, used_ram, used_vcpus):
+        """_score
+
+        Returns the absolute score of a hypervisor given its used resources, or
+        None if the resources exceed its capacity.
+        """
+        hypervisor = self._hypervisors[i]
+        if used_ram > hypervisor.ram_capacity or \
+                used_vcpus > hypervisor.vcpus_capacity:
+            return None
+        return abs(hypervisor.calculate_score(used_ram, used_vcpus))
+
+    def _relocate(self, vm, location):
+        """_relocate
+
+        Changes the location of a VM and keeps track of the displaced VMs.
+        """
+        self._locations[vm] = location
+        if location == self._origins[vm]:
+            position = self._displaced_positions.pop(vm, None)
+            if position is not None:
+                last = self._displaced.pop()
+                if last != vm:
+                    self._displaced[position] = last
+                    self._displaced_positions[last] = position
+        elif vm not in self._displaced_positions:
+            self._displaced_positions[vm] = len(self._displaced)
+            self._displaced.append(vm)
+
+    def _moves(self, vm, destination):
+        """_moves
+
+        Returns the change of the number of moved VMs when a VM is moved to a
+        given hypervisor.
+        """
+        return (self._locations[vm] == self._origins[vm]) - \
+            (destination == self._origins[vm])
+
+    def _propose(self):
+        """_propose
+
+        Proposes a random move (a VM and another hypervisor), a swap (two VMs
+        on different hypervisors) or to move a displaced VM back to its own
+        hypervisor. Returns a tuple containing the change of the
+        total cost, the change of the number of moved VMs and the new
+        locations, used resources and scores, or None if the proposal is not
+        possible.
+        """
+        if self._displaced and self._random.random() < RETURN_CHANCE:
+            vm = self._random.choice(self._displaced)
+            source = self._locations[vm]
+            other = None
+            destination = self._origins[vm]
+        elif self._random.random() < 0.5:
+            vm = self._random.randrange(len(self._vms))
+            source = self._locations[vm]
+            other = None
+            destination = self._random.randrange(len(self._hypervisors) - 1)
+            if destination >= source:
+                destination += 1
+        else:
+            vm = self._random.randrange(len(self._vms))
+            source = self._locations[vm]
+            other = self._random.randrange(len(self._vms))
+            destination = self._locations[other]
+            if destination == source or \
+                    self._vms[vm].ram == self._vms[other].ram and \
+                    self._vms[vm].vcpus == self._vms[other].vcpus:
+                return None
+
+        if self._subjects is not None and source not in self._subjects \
+                and destination not in self._subjects:
+            return None
+
+        ram = self._vms[vm].ram
+        vcpus = self._vms[vm].vcpus
+        moves = self._moves(vm, destination)
+        if other is not None:
+            ram -= self._vms[other].ram
+            vcpus -= self._vms[other].vcpus
+            moves += self._moves(other, source)
+
+        source_ram = self._used_ram[source] - ram
+        source_vcpus = self._used_vcpus[source] - vcpus
+        destination_ram = self._used_ram[destination] + ram
+        destination_vcpus = self._used_vcpus[destination] + vcpus
+        source_score = self._score(source, source_ram, source_vcpus)
+        destination_score = self._score(destination, destination_ram,
+                                        destination_vcpus)
+        if source_score is None or destination_score is None:
+            return None
+
+        delta = source_score + destination_score - self._scores[source] - \
+            self._scores[destination] + moves * self._migration_cost
+        return (delta, moves, [(vm, destination), (other, source)],
+                [(source, source_ram, source_vcpus, source_score),
+                 (destination, destination_ram, destination_vcpus,
+                  destination_score)])
+
+    def _apply(self, locations, usage):
+        """_apply
+
+        Applies a proposal (see `_propose`). Returns the previous locations of
+        the moved VMs, which undo the proposal when applied.
+        """
+        undo = []
+        for vm, location in locations:
+            if vm is not None:
+                undo.append((vm, self._locations[vm]))
+                self._relocate(vm, location)
+        for i, used_ram, used_vcpus, score in usage:
+            self._used_ram[i] = used_ram
+            self._used_vcpus[i] = used_vcpus
+            self._scores[i] = score
+        return undo
+
+    def _undo(self, undo):
+        """_undo
+
+        Moves VMs back to their previous locations.
+        """
+        for vm, location in reversed(undo):
+            current = self._locations[vm]
+            vm_object = self._vms[vm]
+            for i, sign in ((current, -1), (location, 1)):
+                self._used_ram[i] += sign * vm_object.ram
+                self._used_vcpus[i] += sign * vm_object.vcpus
+                self._scores[i] = abs(self._hypervisors[i].calculate_score(
+                    self._used_ram[i], self._used_vcpus[i]))
+            self._relocate(vm, location)
+
+    def run(self, steps=STEPS, temperature=None, deadline=None,
+            max_moved=None):
+        """run
+
+        Proposes the given number of moves (or as many as possible before the
+        `deadline` timestamp), while the temperature cools down geometrically
+        from `temperature` (by default a tenth of the average score) to a
+        thousandth of it. At most `max_moved` VMs are moved. Returns the
+        migrations which result in the best distribution that was found.
+        """
+        if len(self._hypervisors) < 2 or not self._vms:
+            return []
+
+        if temperature is None:
+            temperature = sum(self._scores) / len(self._scores) / 10
+        cooling = 0.001 ** (1 / steps)
+        cost = best_cost = sum(self._scores)
+        start_cost = cost
+        journal = []
+        accepted = 0
+
+        for step in range(steps):
+            if deadline is not None and not step % 1000 and \
+                    time.time() >= deadline:
+                logging.info('Time budget expired after %i steps', step)
+                break
+            temperature *= cooling
+
+            proposal = self._propose()
+            if proposal is None:
+                continue
+            delta, moves, locations, usage = proposal
+            if max_moved is not None and \
+                    len(self._displaced) + moves > max_moved:
+                continue
+            if delta > 0 and (not temperature or self._random.random() >=
+                              math.exp(-delta / temperature)):
+                continue
+
+            journal.extend(self._apply(locations, usage))
+            accepted += 1
+            cost += delta
+            if cost < best_cost:
+                best_cost = cost
+                journal = []
+
+        # Return to the best distribution that was found
+        self._undo(journal)
+        logging.info('Annealing accepted %i moves, cost from %f to %f',
+                     accepted, start_cost, best_cost)
+
+        return [Migration(vm, self._hypervisors[origin],
+                          self._hypervisors[location])
+                for vm, origin, location in zip(self._vms, self._origins,
+                                                self._locations)
+                if origin != location]
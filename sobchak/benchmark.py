@@ -0,0 +1,268 @@
+import json
+import logging
+import platform
+import time
+from sobchak.fake import FakeNovaClient
+from sobchak.inventory import Inventory
+from sobchak.migration import Migration
+
+FORMAT = 'sobchak-benchmark'
+VERSION = 1
+
+class Benchmark(object):
+    """Benchmark
+
+    Times the hot paths of the optimizer on a synthetic inventory (see
+    `sobchak.fake`) with a given number of hypervisors. Every hot path is run
+    `repeat` times and the fastest run is reported, in seconds.
+    """
+
+    def __init__(self, hypervisors, seed=0, repeat=3, plots=5, config={}):
+        self.hypervisors = hypervisors
+        self._seed = seed
+        self._repeat = repeat
+        self._plots = plots
+        self._config = config
+        self._client = None
+        self._inventory = None
+        self._needed_migrations = []
+        self._migrations = []
+
+    def _time(self, function, setup=None):
+        """_time
+
+        Returns the fastest of `repeat` runs of a function. The optional setup
+        function is called before every run and is not timed.
+        """
+        timings = []
+        for _ in range(self._repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    def _reset(self):
+        """_reset
+
+        Reverts the inventory to its initial state.
+        """
+        self._inventory.use_snapshot(0, validate=False)
+
+    def _pair(self):
+        """_pair
+
+        Returns the subject and improvement hypervisors which the optimizer
+        would mix first, or None if there's nothing to improve.
+        """
+        for subject in self._inventory.engine.by_score():
+            if subject.score < 0:
+                improvement = self._inventory.right_divergent
+            else:
+                improvement = self._inventory.left_divergent
+            if improvement:
+                return subject, improvement
+        return None
+
+    def bench_construction(self):
+        """bench_construction
+
+        Creates an inventory and attaches all VMs to their hypervisors.
+        """
+        def _construct():
+            self._inventory = Inventory(self._client, self._config)
+            self._inventory.hypervisors
+        return self._time(_construct)
+
+    def bench_common_ratio(self):
+        """bench_common_ratio
+
+        Counts the VM ratios and determines the most common one.
+        """
+        def _common_ratio():
+            self._inventory._count_ratios()
+            self._inventory.common_ratio
+        return self._time(_common_ratio)
+
+    def bench_score(self):
+        """bench_score
+
+        Calculates the score of every hypervisor.
+        """
+        def _score():
+            for hypervisor in self._inventory.hypervisors:
+                hypervisor.score
+        return self._time(_score)
+
+    def bench_divergence(self):
+        """bench_divergence
+
+        Calculates the divergence of every hypervisor.
+        """
+        def _divergence():
+            for hypervisor in self._inventory.hypervisors:
+                hypervisor.divergence
+        return self._time(_divergence)
+
+    def bench_mix_hypervisors(self):
+        """bench_mix_hypervisors
+
+        Mixes the VMs of the first subject/improvement pair.
+        """
+        pair = self._pair()
+        if not pair:
+            return None
+
+        def _mix():
+            self._needed_migrations = \
+                self._inventory._mix_hypervisors(*pair) or []
+        timing = self._time(_mix, setup=self._reset)
+        self._reset()
+        return timing
+
+    def bench_plan_migrations(self):
+        """bench_plan_migrations
+
+        Plans the migrations needed to realize the first mix.
+        """
+        def _plan():
+            self._migrations = self._inventory._plan_migrations(
+                list(self._needed_migrations))
+        timing = self._time(_plan, setup=self._reset)
+        self._reset()
+        return timing
+
+    def bench_validate_migrations(self):
+        """bench_validate_migrations
+
+        Validates the planned migrations.
+        """
+        timing = self._time(
+            lambda: self._inventory._validate_migrations(self._migrations))
+        self._reset()
+        return timing
+
+    def bench_merge_migrations(self):
+        """bench_merge_migrations
+
+        Merges a list of migrations in which a VM of every hypervisor is
+        migrated twice, with the migrations of the other VMs in between, so
+        every chain has to be collapsed; half of the chains end on their
+        source. The migrations are applied to the inventory first, like the
+        optimizer does.
+        """
+        hypervisors = self._inventory.enabled_hypervisors
+        if len(hypervisors) < 3:
+            return None
+
+        chains = []
+        for i, hypervisor in enumerate(hypervisors):
+            if not hypervisor.servers:
+                continue
+            middle = hypervisors[(i + 1) % len(hypervisors)]
+            last = hypervisor if i % 2 else \
+                hypervisors[(i + 2) % len(hypervisors)]
+            chains.append((hypervisor.servers[0], hypervisor, middle, last))
+
+        migrations = []
+
+        def _migrate(vm, source, destination):
+            assert source.remove_server(vm)
+            if not destination.add_server(vm):
+                assert source.add_server(vm, force=True)
+                return False
+            migrations.append(Migration(vm, source, destination))
+            return True
+
+        chains = [chain for chain in chains if _migrate(*chain[:3])]
+        for vm, _, middle, last in chains:
+            _migrate(vm, middle, last)
+
+        timing = self._time(
+            lambda: self._inventory._merge_migrations(migrations))
+        self._reset()
+        return timing
+
+    def bench_plot(self):
+        """bench_plot
+
+        Plots the first hypervisors (the cost per plot does not depend on the
+        size of the inventory).
+        """
+        def _plot():
+            for hypervisor in self._inventory.hypervisors[:self._plots]:
+                hypervisor.plot
+        return self._time(_plot)
+
+    def run(self):
+        """run
+
+        Runs all benchmarks and returns a dictionary containing their timings.
+        """
+        logging.info('Generating synthetic cluster of %i hypervisors',
+                     self.hypervisors)
+        self._client = FakeNovaClient(self.hypervisors, seed=self._seed,
+                                      config=self._config)
+
+        results = {}
+        for name in ['construction', 'common_ratio', 'score', 'divergence',
+                     'mix_hypervisors', 'plan_migrations',
+                     'validate_migrations', 'merge_migrations', 'plot']:
+            logging.info('Running %s (%i hypervisors)', name, self.hypervisors)
+            results[name] = getattr(self, 'bench_' + name)()
+            logging.info('%s: %s', name, results[name])
+        return results
+
+def run_suite(sizes, seed=0, repeat=3, config={}):
+    """run_suite
+
+    Runs the benchmarks for every given inventory size and returns the results
+    as a dictionary which can be saved as JSON.
+    """
+    return {
+        'format': FORMAT,
+        'version': VERSION,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': {str(size): Benchmark(size, seed, repeat,
+                                         config=config).run()
+                    for size in sizes},
+    }
+
+def compare(results, baseline, threshold=0.2):
+    """compare
+
+    Compares benchmark results with a baseline and returns a list of tuples
+    (size, benchmark, baseline timing, timing) of the benchmarks which became
+    slower than the baseline by more than the threshold (a fraction).
+    """
+    regressions = []
+    for size, timings in results['results'].items():
+        for name, timing in timings.items():
+            reference = baseline['results'].get(size, {}).get(name)
+            if timing is None or reference is None:
+                continue
+            if timing > reference * (1 + threshold):
+                regressions.append((size, name, reference, timing))
+    return regressions
+
+def save(results, filename):
+    """save
+
+    Saves benchmark results as a JSON file.
+    """
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+def load(filename):
+    """load
+
+    Loads benchmark results from a JSON file.
+    """
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        logging.error('Could not load %s: %s', filename, e)
+        exit(1)
@@ -0,0 +1,107 @@
+import logging
+from bisect import bisect_left, insort
+
+class CapacityIndex(object):
+    """CapacityIndex
+
+    A CapacityIndex object keeps the enabled hypervisors ordered by their
+    available resources, so the hypervisor which fits a VM the tightest can be
+    found without sorting all hypervisors. Hypervisors are grouped in buckets by
+    their number of available VCPUs; every bucket is a sorted list of (available
+    RAM, position) tuples.
+
+    Hypervisors report every change of their VMs or resources to the index
+    they're watched by (see `CustomHypervisor.capacity_index`), after which
+    they're reindexed before the next query.
+    """
+
+    def __init__(self, hypervisors, common_ratio):
+        self._hypervisors = list(hypervisors)
+        self._positions = {h.id: i for i, h in enumerate(self._hypervisors)}
+        self._common_ratio = common_ratio
+        self._buckets = {}
+        self._vcpus = []
+        self._entries = {}
+        self._dirty = {}
+        for hypervisor in self._hypervisors:
+            hypervisor.capacity_index = self
+            self._insert(hypervisor)
+        logging.debug('Initialized capacity index for %i hypervisors',
+                      len(self._hypervisors))
+
+    def touch(self, hypervisor):
+        """touch
+
+        Marks a hypervisor as changed, so it's reindexed before the next query.
+        """
+        self._dirty[hypervisor.id] = hypervisor
+
+    def _sync(self):
+        """_sync
+
+        Reindexes the hypervisors which changed since the last query.
+        """
+        for hypervisor in self._dirty.values():
+            if hypervisor.id in self._positions:
+                self._remove(hypervisor)
+                self._insert(hypervisor)
+        self._dirty = {}
+
+    def _insert(self, hypervisor):
+        """_insert
+
+        Adds an (enabled) hypervisor to the bucket of its available VCPUs.
+        """
+        if not hypervisor.enabled:
+            return
+        vcpus = hypervisor.available_vcpus
+        entry = (hypervisor.available_ram, self._positions[hypervisor.id])
+        if vcpus not in self._buckets:
+            self._buckets[vcpus] = []
+            insort(self._vcpus, vcpus)
+        insort(self._buckets[vcpus], entry)
+        self._entries[hypervisor.id] = (vcpus, entry)
+
+    def _remove(self, hypervisor):
+        """_remove
+
+        Removes a hypervisor from its bucket, if it was indexed.
+        """
+        if hypervisor.id not in self._entries:
+            return
+        vcpus, entry = self._entries.pop(hypervisor.id)
+        bucket = self._buckets[vcpus]
+        del bucket[bisect_left(bucket, entry)]
+        if not bucket:
+            del self._buckets[vcpus]
+            del self._vcpus[bisect_left(self._vcpus, vcpus)]
+
+    def find(self, server, exclude=()):
+        """find
+
+        Returns the enabled hypervisor which has enough available resources to
+        host a given VM and would have the fewest resources left, counting every
+        VCPU as the amount of RAM of the most common ratio. Hypervisors with an
+        ID in `exclude` are skipped. Returns None if no hypervisor fits.
+        """
+        self._sync()
+        best = None
+        best_waste = None
+        for i in range(bisect_left(self._vcpus, server.vcpus),
+                       len(self._vcpus)):
+            vcpus = self._vcpus[i]
+            vcpus_waste = (vcpus - server.vcpus) * self._common_ratio
+            if best is not None and vcpus_waste >= best_waste:
+                break
+            bucket = self._buckets[vcpus]
+            for j in range(bisect_left(bucket, (server.ram, -1)), len(bucket)):
+                ram, position = bucket[j]
+                hypervisor = self._hypervisors[position]
+                if hypervisor.id in exclude:
+                    continue
+                waste = ram - server.ram + vcpus_waste
+                if best is None or waste < best_waste:
+                    best = hypervisor
+                    best_waste = waste
+                break
+        return best
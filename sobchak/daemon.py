@@ -0,0 +1,60 @@
+import logging
+import time
+
+class Daemon(object):
+    """Daemon
+
+    Keeps an inventory in memory and refreshes it periodically, so an
+    up-to-date list of migrations is available without fetching all servers
+    again. After every refresh the previous migrations are replayed on the new
+    state and only the hypervisors which changed are optimized again. The
+    given options (e.g. `iterations`) are passed on to `Inventory.optimize`.
+    """
+
+    def __init__(self, inventory, interval=300, callback=None, **options):
+        self.inventory = inventory
+        self.migrations = None
+        self._interval = interval
+        self._callback = callback
+        self._options = options
+
+    def cycle(self):
+        """cycle
+
+        Fetches (the first time) or refreshes the inventory, updates the list of
+        migrations and returns it.
+        """
+        if self.migrations is None:
+            self.migrations = self.inventory.optimize(**self._options)
+            return self.migrations
+
+        changed = self.inventory.refresh()
+        migrations = self.inventory.revalidate(self.migrations)
+        if changed:
+            logging.info('Optimizing %i changed hypervisors', len(changed))
+            migrations = self.inventory.optimize(migrations=migrations,
+                                                 subjects=changed,
+                                                 **self._options)
+        self.migrations = migrations
+        return self.migrations
+
+    def run(self, cycles=None):
+        """run
+
+        Runs a cycle every `interval` seconds (forever, or the given number of
+        times) and passes the inventory and the migrations to the callback after
+        every cycle.
+        """
+        while cycles is None or cycles > 0:
+            start = time.monotonic()
+            migrations = self.cycle()
+            logging.info('Cycle done in %.1f seconds, %i migrations',
+                         time.monotonic() - start, len(migrations))
+            if self._callback:
+                self._callback(self.inventory, migrations)
+
+            if cycles is not None:
+                cycles -= 1
+                if not cycles:
+                    break
+            time.sleep(max(0, self._interval - (time.monotonic() - start)))
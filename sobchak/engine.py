@@ -0,0 +1,295 @@
+import heapq
+import logging
+import numpy
+
+class ScoringEngine(object):
+    """ScoringEngine
+
+    A ScoringEngine object holds the resources of all hypervisors and the VMs
+    they host in NumPy arrays, so the score and divergence of the whole cluster
+    can be calculated in one vectorized pass. The results are the same as those
+    of the `score` and `divergence` properties of CustomHypervisor objects.
+
+    Hypervisors report every change of their VMs or resources to the engine
+    they're watched by (see `CustomHypervisor.engine`), so only those are
+    recalculated by the next refresh. The enabled hypervisors with a negative (positive) score are kept in a
+    heap ordered by their left-handed (right-handed) divergence, so finding the
+    most divergent one takes O(log H). Outdated heap entries are recognized by
+    the revision of their hypervisor and dropped when they come up.
+    """
+
+    def __init__(self, hypervisors, common_ratio):
+        self._hypervisors = list(hypervisors)
+        self._common_ratio = common_ratio
+        self._revisions = [None] * len(self._hypervisors)
+        self._positions = {h.id: i for i, h in enumerate(self._hypervisors)}
+        self._dirty = set(range(len(self._hypervisors)))
+        for hypervisor in self._hypervisors:
+            hypervisor.engine = self
+
+        self._memory_mb = numpy.array(
+            [h.memory_mb for h in self._hypervisors], dtype=float)
+        self._vcpus = numpy.array(
+            [h.vcpus for h in self._hypervisors], dtype=float)
+        self._ram_capacity = numpy.array(
+            [h.ram_capacity for h in self._hypervisors], dtype=float)
+        self._vcpus_capacity = numpy.array(
+            [h.vcpus_capacity for h in self._hypervisors], dtype=float)
+        self._enabled = numpy.array(
+            [h.enabled for h in self._hypervisors], dtype=bool)
+
+        servers = [vm for h in self._hypervisors for vm in h.servers]
+        self._server_index = {vm.id: i for i, vm in enumerate(servers)}
+        self._ram = numpy.array([vm.ram for vm in servers], dtype=float)
+        self._server_vcpus = numpy.array([vm.vcpus for vm in servers],
+                                         dtype=float)
+        self._server_divergence = self.calculate_divergence(common_ratio)
+
+        size = len(self._hypervisors)
+        self._used_ram = numpy.zeros(size)
+        self._used_vcpus = numpy.zeros(size)
+        self._left = numpy.zeros(size)
+        self._right = numpy.zeros(size)
+        self._scores = numpy.zeros(size)
+        self._left_heap = []
+        self._right_heap = []
+        self.refresh()
+        logging.debug('Initialized scoring engine for %i hypervisors',
+                      len(self._hypervisors))
+
+    @property
+    def ratios(self):
+        """ratios
+
+        Returns the RAM/vCPU ratio of every VM, rounded down to the nearest
+        integer like `CustomServer.ratio`.
+        """
+        return numpy.trunc(self._ram / self._server_vcpus)
+
+    @property
+    def lengths(self):
+        """lengths
+
+        Returns the length of the resource vector of every VM.
+        """
+        return numpy.sqrt(self._ram * self._ram +
+                          self._server_vcpus * self._server_vcpus)
+
+    def calculate_divergence(self, reference):
+        """calculate_divergence
+
+        Returns the divergence of every VM from a reference slope. See
+        `CustomServer.calculate_divergence`.
+        """
+        angle = numpy.arctan(self.ratios) - numpy.arctan(reference)
+        return self.lengths * numpy.sin(angle)
+
+    def touch(self, hypervisor):
+        """touch
+
+        Marks a hypervisor as changed, so it's recalculated by the next
+        refresh.
+        """
+        position = self._positions.get(hypervisor.id)
+        if position is not None:
+            self._dirty.add(position)
+
+    def refresh(self):
+        """refresh
+
+        Reloads the VMs of every hypervisor which changed since the last
+        refresh and recalculates the used resources, divergence and score of
+        those hypervisors. When many hypervisors changed, everything is
+        recalculated at once.
+        """
+        if not self._dirty:
+            return
+        changed = sorted(self._dirty)
+        self._dirty = set()
+
+        for i in changed:
+            self._revisions[i] = self._hypervisors[i].revision
+
+        if len(changed) * 4 > len(self._hypervisors):
+            self._recalculate()
+            return
+
+        for i in changed:
+            servers = numpy.array(
+                [self._server_index[vm.id]
+                 for vm in self._hypervisors[i].servers], dtype=int)
+            divergence = self._server_divergence[servers]
+            self._used_ram[i] = self._ram[servers].sum()
+            self._used_vcpus[i] = self._server_vcpus[servers].sum()
+            self._left[i] = -divergence[divergence < 0].sum()
+            self._right[i] = divergence[divergence >= 0].sum()
+
+        changed = numpy.array(changed, dtype=int)
+        self._scores[changed] = self._calculate_scores(changed)
+        for i in changed:
+            self._push(i)
+
+        # Drop the outdated entries once the heaps grow too large
+        if len(self._left_heap) + len(self._right_heap) > \
+                4 * len(self._hypervisors):
+            self._rebuild_heaps()
+
+    def _recalculate(self):
+        """_recalculate
+
+        Recalculates the used resources, divergence and score of all
+        hypervisors and rebuilds the heaps.
+        """
+        host = []
+        servers = []
+        for i, hypervisor in enumerate(self._hypervisors):
+            for vm in hypervisor.servers:
+                host.append(i)
+                servers.append(self._server_index[vm.id])
+        host = numpy.array(host, dtype=int)
+        servers = numpy.array(servers, dtype=int)
+
+        size = len(self._hypervisors)
+        divergence = self._server_divergence[servers]
+        self._used_ram = numpy.bincount(
+            host, weights=self._ram[servers], minlength=size)
+        self._used_vcpus = numpy.bincount(
+            host, weights=self._server_vcpus[servers], minlength=size)
+        self._left = numpy.bincount(
+            host, weights=numpy.where(divergence < 0, -divergence, 0),
+            minlength=size)
+        self._right = numpy.bincount(
+            host, weights=numpy.where(divergence < 0, 0, divergence),
+            minlength=size)
+        self._scores = self._calculate_scores(numpy.arange(size))
+        self._rebuild_heaps()
+
+    def _calculate_scores(self, indices):
+        """_calculate_scores
+
+        Returns the scores of the hypervisors with the given indices. See
+        `CustomHypervisor.score`.
+        """
+        available_ram = numpy.trunc(self._ram_capacity[indices] -
+                                    self._used_ram[indices])
+        available_vcpus = numpy.trunc(self._vcpus_capacity[indices] -
+                                      self._used_vcpus[indices])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            ratio = numpy.where(available_vcpus == 0, available_ram,
+                                numpy.trunc(available_ram / available_vcpus))
+
+        def _sigmoid(x):
+            return x / (1 + numpy.abs(x))
+
+        weight_ram = _sigmoid(available_ram / self._memory_mb[indices])
+        weight_vcpus = _sigmoid(available_vcpus / self._vcpus[indices])
+        angle = numpy.arctan(self._common_ratio) - numpy.arctan(ratio)
+        return angle * (weight_ram + weight_vcpus)
+
+    def _push(self, i):
+        """_push
+
+        Adds the current state of the hypervisor with the given index to the
+        heap it belongs in, if any.
+        """
+        if not self._enabled[i]:
+            return
+        if self._scores[i] < 0:
+            heapq.heappush(self._left_heap,
+                           (-self._left[i], i, self._revisions[i]))
+        elif self._scores[i] > 0:
+            heapq.heappush(self._right_heap,
+                           (-self._right[i], i, self._revisions[i]))
+
+    def _rebuild_heaps(self):
+        """_rebuild_heaps
+
+        Rebuilds the heaps from the current state of all hypervisors.
+        """
+        enabled = self._enabled
+        self._left_heap = [(-self._left[i], i, self._revisions[i]) for i in
+                           numpy.flatnonzero(enabled & (self._scores < 0))]
+        self._right_heap = [(-self._right[i], i, self._revisions[i]) for i in
+                            numpy.flatnonzero(enabled & (self._scores > 0))]
+        heapq.heapify(self._left_heap)
+        heapq.heapify(self._right_heap)
+
+    @property
+    def scores(self):
+        """scores
+
+        Returns the score of every hypervisor. See `CustomHypervisor.score`.
+        """
+        self.refresh()
+        return self._scores
+
+    @property
+    def total_score(self):
+        """total_score
+
+        Returns the sum of the absolute scores of all enabled hypervisors. The
+        closer to zero, the better the resources are distributed.
+        """
+        return float(numpy.abs(self.scores[self._enabled]).sum())
+
+    @property
+    def divergences(self):
+        """divergences
+
+        Returns a tuple containing the left- and right-handed divergence of
+        every hypervisor. See `CustomHypervisor.divergence`.
+        """
+        self.refresh()
+        return (self._left, self._right)
+
+    def _most_divergent(self, heap, exclude=()):
+        """_most_divergent
+
+        Returns the hypervisor at the top of a heap, or None if the heap is
+        empty. Hypervisors with an ID in `exclude` are not taken into account.
+        """
+        skipped = []
+        most_divergent = None
+        while heap:
+            _, i, revision = heap[0]
+            if revision != self._revisions[i]:
+                heapq.heappop(heap)
+            elif self._hypervisors[i].id in exclude:
+                skipped.append(heapq.heappop(heap))
+            else:
+                most_divergent = self._hypervisors[i]
+                break
+
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        return most_divergent
+
+    def left_divergent(self, exclude=()):
+        """left_divergent
+
+        Returns the enabled hypervisor which is the most divergent to the left
+        and has a negative score. Returns None if no hypervisors fit that
+        profile. Hypervisors with an ID in `exclude` are skipped.
+        """
+        self.refresh()
+        return self._most_divergent(self._left_heap, exclude)
+
+    def right_divergent(self, exclude=()):
+        """right_divergent
+
+        Returns the enabled hypervisor which is the most divergent to the right
+        and has a positive score. Returns None if no hypervisors fit that
+        profile. Hypervisors with an ID in `exclude` are skipped.
+        """
+        self.refresh()
+        return self._most_divergent(self._right_heap, exclude)
+
+    def by_score(self):
+        """by_score
+
+        Returns a list of enabled hypervisors, ordered from the highest to the
+        lowest absolute score.
+        """
+        enabled = numpy.flatnonzero(self._enabled)
+        order = numpy.argsort(numpy.abs(self.scores[enabled]), kind='stable')
+        return [self._hypervisors[i] for i in enabled[order[::-1]]]
@@ -0,0 +1,107 @@
+import logging
+import random
+import uuid
+from sobchak.offline import OfflineClient
+
+# Flavors as (name, RAM in MB, VCPUs, relative popularity)
+FLAVORS = [
+    ('general.small', 2048, 1, 20),
+    ('general.medium', 4096, 2, 25),
+    ('general.large', 8192, 4, 20),
+    ('general.xlarge', 16384, 8, 8),
+    ('memory.large', 16384, 2, 6),
+    ('memory.xlarge', 32768, 4, 5),
+    ('memory.2xlarge', 65536, 8, 2),
+    ('compute.large', 4096, 4, 6),
+    ('compute.xlarge', 8192, 8, 5),
+    ('compute.2xlarge', 16384, 16, 3),
+]
+
+# Hypervisor models as (physical CPUs, RAM in MB, relative popularity)
+HYPERVISOR_MODELS = [
+    (32, 262144, 3),
+    (48, 393216, 2),
+    (64, 524288, 1),
+]
+
+def generate_cluster(hypervisors=100, flavors=FLAVORS, fill=0.8, seed=0,
+                     config={}):
+    """generate_cluster
+
+    Generates a synthetic cluster and returns a tuple containing lists of
+    hypervisor, flavor and server records (see `sobchak.offline`). Hypervisors
+    are filled up to roughly the given fill level with VMs of the given flavor
+    mix. Like naive scheduling does, every hypervisor favours a part of the
+    flavors, so the resulting resource distribution leaves room for
+    improvement. The same seed always generates the same cluster.
+    """
+    rng = random.Random(seed)
+    ram_overcommit = config.get('ram_overcommit', 1)
+    cpu_overcommit = config.get('cpu_overcommit', 4)
+    memory_overhead = config.get('hypervisor_memory_overhead', 32768)
+
+    flavor_records = [{'id': str(i + 1), 'name': name, 'ram': ram,
+                       'vcpus': vcpus}
+                      for i, (name, ram, vcpus, _) in enumerate(flavors)]
+
+    hypervisor_records = []
+    server_records = []
+    for i in range(hypervisors):
+        cpus, memory_mb, _ = rng.choices(
+            HYPERVISOR_MODELS, weights=[m[2] for m in HYPERVISOR_MODELS])[0]
+        hostname = 'compute{:05d}.example.com'.format(i + 1)
+        ram_capacity = memory_mb * ram_overcommit - memory_overhead
+        vcpus_capacity = cpus * cpu_overcommit
+        host_fill = min(1.0, max(0.0, fill + rng.uniform(-0.1, 0.1)))
+
+        # Favour memory- or compute-heavy flavors on this hypervisor
+        bias = rng.uniform(0.25, 4)
+        weights = [weight * (bias if ram / vcpus > 4096 else 1 / bias)
+                   for _, ram, vcpus, weight in flavors]
+
+        used_ram = used_vcpus = 0
+        misses = 0
+        while misses < 3:
+            flavor = rng.choices(flavor_records, weights=weights)[0]
+            if used_ram + flavor['ram'] > ram_capacity * host_fill or \
+                    used_vcpus + flavor['vcpus'] > vcpus_capacity * host_fill:
+                misses += 1
+                continue
+            used_ram += flavor['ram']
+            used_vcpus += flavor['vcpus']
+            server_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            server_records.append({
+                'id': server_id,
+                'name': 'vm-{}'.format(server_id[:8]),
+                'status': 'ACTIVE' if rng.random() < 0.95 else 'SHUTOFF',
+                'flavor_id': flavor['id'],
+                'hypervisor': hostname,
+            })
+
+        hypervisor_records.append({
+            'id': i + 1,
+            'hypervisor_hostname': hostname,
+            'status': 'enabled',
+            'vcpus': cpus,
+            'vcpus_used': used_vcpus,
+            'memory_mb': memory_mb,
+            'memory_mb_used': used_ram + memory_overhead,
+        })
+
+    rng.shuffle(server_records)
+    logging.info('Generated %i hypervisors and %i servers', hypervisors,
+                 len(server_records))
+    return hypervisor_records, flavor_records, server_records
+
+class FakeNovaClient(OfflineClient):
+    """FakeNovaClient
+
+    An in-process stand-in for the Nova client which serves a synthetic cluster
+    (see `generate_cluster`), so the optimizer can be run and benchmarked
+    without an OpenStack cloud.
+    """
+
+    def __init__(self, hypervisors=100, flavors=FLAVORS, fill=0.8, seed=0,
+                 config={}):
+        OfflineClient.__init__(self, *generate_cluster(
+            hypervisors, flavors, fill, seed, config))
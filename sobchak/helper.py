@@ -8,18 +8,74 @@ def sigmoid(x):
     """
     return x / (1 + abs(x))
 
-def get_object_by_id(objects, identifier):
+class ObjectIndex(object):
+    """ObjectIndex
+
+    Maps the IDs and names of objects to the objects themselves, so they can be
+    looked up in constant time. IDs take precedence over names.
+    """
+
+    def __init__(self, objects=[]):
+        self._ids = {}
+        self._names = {}
+        for obj in objects:
+            self.add(obj)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids.values())
+
+    def __contains__(self, identifier):
+        return identifier in self._ids or identifier in self._names
+
+    def add(self, obj):
+        """add
+
+        Adds an object to the index.
+        """
+        self._ids[obj.id] = obj
+        self._names.setdefault(obj.name, obj)
+
+    def remove(self, obj):
+        """remove
+
+        Removes an object from the index.
+        """
+        self._ids.pop(obj.id, None)
+        if self._names.get(obj.name) is obj:
+            del self._names[obj.name]
+
+    def get_by_id(self, identifier):
+        """get_by_id
+
+        Returns the object which has the given ID (names are not taken into
+        account). Returns None if it wasn't found.
+        """
+        return self._ids.get(identifier)
+
+    def get(self, identifier):
+        """get
+
+        Returns the object which has the given ID or name. Returns None if it
+        wasn't found.
+        """
+        obj = self._ids.get(identifier)
+        if obj is None:
+            obj = self._names.get(identifier)
+        return obj
+
+def get_object_by_id(index, identifier):
     """get_object_by_id
 
-    Returns the object which belongs to the given ID. Returns None if it wasn't
-    found.
+    Returns the object which belongs to the given ID inside an ObjectIndex.
+    Returns None if it wasn't found.
     """
-    logging.debug('Searching for %s inside %s', identifier, objects)
-    for obj in objects:
-        if obj.id == identifier or obj.name == identifier:
-            return obj
-    logging.info('Could not find %s inside %s', identifier, objects)
-    return None
+    obj = index.get(identifier)
+    if obj is None:
+        logging.info('Could not find %s', identifier)
+    return obj
 
 def parse_config(filename):
     """parse_config
@@ -1,26 +1,44 @@
+import copy
 import logging
 from math import atan
-from novaclient.v2.hypervisors import Hypervisor
 from sobchak.helper import sigmoid
 from sobchak.plot import Plot
 
-class CustomHypervisor(Hypervisor):
+class CustomHypervisor(object):
     """CustomHypervisor
 
     A CustomHypervisor object contains information about its available resources
-    and the VMs it hosts.
+    and the VMs it hosts. Only the fields the optimizer needs are copied from the
+    API resource. Changes are reported to the CapacityIndex in
+    `capacity_index` and the ScoringEngine in `engine`, if any.
     """
 
+    __slots__ = ('id', 'name', 'status', 'vcpus', 'vcpus_used', 'memory_mb',
+                 'memory_mb_used', 'revision', 'capacity_index', 'engine',
+                 '_servers',
+                 '_used_ram', '_used_vcpus', '_journal', '_pending',
+                 '_position', '_snapshots', '_common_ratio', '_ram_overcommit',
+                 '_cpu_overcommit', '_memory_overhead', '_ram_capacity',
+                 '_vcpus_capacity', '_gave_cpu_warning', '_gave_ram_warning')
+
     def __init__(self, hypervisor, common_ratio, config={}):
-        Hypervisor.__init__(self, hypervisor.manager, hypervisor._info)
-        self.servers = []
-        self._server_snapshot = []
+        self._servers = {}
+        self._used_ram = 0
+        self._used_vcpus = 0
+        self.revision = 0
+        self.capacity_index = None
+        self.engine = None
+        self._journal = []
+        self._pending = []
+        self._position = 0
+        self._snapshots = []
         self._common_ratio = common_ratio
         self._ram_overcommit = config.get('ram_overcommit', 1)
         self._cpu_overcommit = config.get('cpu_overcommit', 4)
         self._memory_overhead = config.get('hypervisor_memory_overhead', 32768)
         self._gave_cpu_warning = False
         self._gave_ram_warning = False
+        self.update(hypervisor)
         logging.debug('Initialized hypervisor: %s', self.id)
 
     def __str__(self):
@@ -29,24 +47,170 @@ class CustomHypervisor(Hypervisor):
     def __repr__(self):
         return self.__str__()
 
+    def update(self, hypervisor):
+        """update
+
+        Copies the status and resources of a hypervisor resource fetched from
+        the OpenStack API. Returns True if the status or the capacity of the
+        hypervisor changed.
+        """
+        info = hypervisor._info
+        changed = not hasattr(self, 'id') or \
+            (self.status, self.vcpus, self.memory_mb) != \
+            (info['status'], info['vcpus'], info['memory_mb'])
+        self.id = info['id']
+        self.name = info['hypervisor_hostname']
+        self.status = info['status']
+        self.vcpus = info['vcpus']
+        self.vcpus_used = info['vcpus_used']
+        self.memory_mb = info['memory_mb']
+        self.memory_mb_used = info['memory_mb_used']
+        self._ram_capacity = self.memory_mb * self._ram_overcommit \
+            - self._memory_overhead
+        self._vcpus_capacity = self.vcpus * self._cpu_overcommit
+        if changed:
+            self._touch()
+        return changed
+
+    def reset_snapshots(self):
+        """reset_snapshots
+
+        Forgets all snapshots, so the next snapshot becomes the initial state.
+        """
+        self._journal = []
+        self._pending = []
+        self._position = 0
+        self._snapshots = []
+
+    def clone(self):
+        """clone
+
+        Returns a copy of the hypervisor hosting the same VMs, without its
+        snapshots (e.g. to send it to another process).
+        """
+        clone = copy.copy(self)
+        clone._servers = dict(self._servers)
+        clone.capacity_index = None
+        clone.engine = None
+        clone.reset_snapshots()
+        return clone
+
     def snapshot(self, validate=True):
         """snapshot
 
-        Saves the current VM list.
+        Saves the current VM list. Snapshots are stored as positions in a
+        journal of changes relative to the state of the first snapshot, so only
+        the VMs which were added or removed since the last snapshot are stored.
+        Returns the index of the snapshot.
         """
-        self._server_snapshot.append([s for s in self.servers])
+        changes = self._pending
+        if self._position < len(self._journal):
+            # The current state branched off an older snapshot, so first undo
+            # the changes made after that snapshot to keep the journal linear
+            changes = [(server, not added) for server, added
+                       in reversed(self._journal[self._position:])] + changes
+        self._journal.extend(_net_changes(changes))
+        self._pending = []
+        self._position = len(self._journal)
+        self._snapshots.append(self._position)
         if validate:
             self.verify_available_resources()
+        return len(self._snapshots) - 1
 
     def use_snapshot(self, index=-1, validate=True):
         """use_snapshot
 
-        Resets the VM list to the last snapshot.
+        Resets the VM list to the last snapshot (or to the snapshot with the
+        given index) by rolling the journal back or forward.
         """
-        self.servers = [s for s in self._server_snapshot[index]]
+        target = self._snapshots[index]
+        self._apply(reversed(self._pending), undo=True)
+        self._pending = []
+        if target < self._position:
+            self._apply(reversed(self._journal[target:self._position]),
+                        undo=True)
+        else:
+            self._apply(self._journal[self._position:target])
+        self._position = target
         if validate:
             self.verify_available_resources()
 
+    def _apply(self, changes, undo=False):
+        """_apply
+
+        Applies (or undoes) a sequence of journal entries without recording
+        them.
+        """
+        for server, added in changes:
+            if added != undo:
+                self._attach(server)
+            else:
+                self._detach(server)
+
+    def _record(self, server, added):
+        """_record
+
+        Records that a VM was added to or removed from this hypervisor since
+        the last snapshot. Nothing is recorded before the first snapshot, as
+        that state is the base of the journal.
+        """
+        if self._snapshots:
+            self._pending.append((server, added))
+
+    def _attach(self, server):
+        """_attach
+
+        Adds a VM to the VM list and updates the used resources.
+        """
+        self._servers[server.id] = server
+        self._used_ram += server.ram
+        self._used_vcpus += server.vcpus
+        self._touch()
+
+    def _detach(self, server):
+        """_detach
+
+        Removes a VM from the VM list and updates the used resources.
+        """
+        del self._servers[server.id]
+        self._used_ram -= server.ram
+        self._used_vcpus -= server.vcpus
+        self._touch()
+
+    def _touch(self):
+        """_touch
+
+        Increases the revision and reports the change to the CapacityIndex and
+        ScoringEngine which watch this hypervisor.
+        """
+        self.revision += 1
+        if self.capacity_index:
+            self.capacity_index.touch(self)
+        if self.engine:
+            self.engine.touch(self)
+
+    def resources_match(self):
+        """resources_match
+
+        Returns True if OpenStack agrees with our calculated available
+        resources.
+        """
+        available_vcpus_check = int(self.vcpus * self._cpu_overcommit \
+            - self.vcpus_used)
+        available_ram_check = int(self.memory_mb * self._ram_overcommit \
+            - self.memory_mb_used)
+        return self.available_vcpus == available_vcpus_check and \
+            self.available_ram == available_ram_check
+
+    def adopt_calculated_resources(self):
+        """adopt_calculated_resources
+
+        Overwrites the used resources reported by OpenStack with our calculated
+        ones, e.g. when they were fetched at a slightly different moment.
+        """
+        self.vcpus_used = self._used_vcpus
+        self.memory_mb_used = self._used_ram + self._memory_overhead
+
     def verify_available_resources(self):
         """verify_available_resources
 
@@ -119,7 +283,7 @@ class CustomHypervisor(Hypervisor):
 
         if plot_improvement:
             # Take a snapshot of the current state
-            self.snapshot()
+            self.snapshot(validate=False)
 
             # Revert back to the initial state
             self.use_snapshot(0)
@@ -129,7 +293,7 @@ class CustomHypervisor(Hypervisor):
             plot.add_graph(x, y, 'Hosted VMs (before)')
 
             # Revert back to "newest" state
-            self.use_snapshot()
+            self.use_snapshot(validate=False)
 
         # Grey-out graph if hypervisor is disabled
         if not self.enabled:
@@ -154,12 +318,24 @@ class CustomHypervisor(Hypervisor):
         return plot.base64
 
     @property
-    def name(self):
-        """name
+    def servers(self):
+        """servers
 
-        Returns the hypervisor domain name.
+        Returns the list of VMs hosted on this hypervisor, in the order they
+        were added.
         """
-        return self.hypervisor_hostname
+        return list(self._servers.values())
+
+    @servers.setter
+    def servers(self, servers):
+        """servers
+
+        Replaces the list of hosted VMs and recalculates the used resources.
+        """
+        self.pop()
+        for server in servers:
+            self._attach(server)
+            self._record(server, True)
 
     @property
     def enabled(self):
@@ -169,6 +345,57 @@ class CustomHypervisor(Hypervisor):
         """
         return self.status == 'enabled'
 
+    @property
+    def common_ratio(self):
+        """common_ratio
+
+        Returns the most common RAM/vCPU ratio this hypervisor steers towards.
+        """
+        return self._common_ratio
+
+    @common_ratio.setter
+    def common_ratio(self, common_ratio):
+        """common_ratio
+
+        Sets the most common RAM/vCPU ratio this hypervisor steers towards.
+        """
+        self._common_ratio = common_ratio
+        self._touch()
+
+    @property
+    def used_ram(self):
+        """used_ram
+
+        Returns the amount of RAM in MB's used by the hosted VMs.
+        """
+        return self._used_ram
+
+    @property
+    def used_vcpus(self):
+        """used_vcpus
+
+        Returns the number of VCPU's used by the hosted VMs.
+        """
+        return self._used_vcpus
+
+    @property
+    def ram_capacity(self):
+        """ram_capacity
+
+        Returns the amount of RAM in MB's which can be assigned to VMs, taking
+        memory overhead and the overcommit ratio into account.
+        """
+        return self._ram_capacity
+
+    @property
+    def vcpus_capacity(self):
+        """vcpus_capacity
+
+        Returns the number of VCPU's which can be assigned to VMs, taking the
+        overcommit ratio into account.
+        """
+        return self._vcpus_capacity
+
     @property
     def available_ram(self):
         """available_ram
@@ -177,9 +404,7 @@ class CustomHypervisor(Hypervisor):
         the overcommit ratio into account. Note that memory overhead is already
         calculated into `self.memory_mb_used`.
         """
-        available_ram = int(self.memory_mb * self._ram_overcommit \
-            - sum([vm.ram for vm in self.servers]) \
-            - self._memory_overhead)
+        available_ram = int(self._ram_capacity - self._used_ram)
 
         if available_ram < 0 and not self._gave_ram_warning:
             logging.warning('Used memory above overcommit treshold on %s',
@@ -194,8 +419,7 @@ class CustomHypervisor(Hypervisor):
 
         Returns the number of available VCPU's.
         """
-        available_vcpus = int(self.vcpus * self._cpu_overcommit \
-            - sum([vm.vcpus for vm in self.servers]))
+        available_vcpus = int(self._vcpus_capacity - self._used_vcpus)
 
         if available_vcpus < 0 and not self._gave_cpu_warning:
             logging.warning('Used vCPUS above overcommit treshold on %s',
@@ -239,32 +463,72 @@ class CustomHypervisor(Hypervisor):
         ratio amongst VMs and the RAM/vCPU ratio of available resources of this
         hypervisor. The closer to zero, the better the score.
         """
+        return self.calculate_score(self._used_ram, self._used_vcpus)
+
+    def calculate_score(self, used_ram, used_vcpus):
+        """calculate_score
+
+        Returns the score of this hypervisor given an amount of used RAM and
+        VCPUs, without changing anything. See `score` for more information.
+
+        This is the side-effect-free trial scoring API: it supersedes
+        `score_if_added` and `score_if_removed`, since the repartitioning and
+        the annealer score hypothetical totals of several VMs rather than the
+        hypervisor's own VMs plus or minus a single one.
+        """
         # TODO: Account for CPU/RAM cost
-        weight_ram = sigmoid(self.available_ram / self.memory_mb)
-        weight_vcpus = sigmoid(self.available_vcpus / self.vcpus)
-        angle = atan(self._common_ratio) - atan(self.ratio)
+        available_ram = int(self._ram_capacity - used_ram)
+        available_vcpus = int(self._vcpus_capacity - used_vcpus)
+        if not available_vcpus:
+            ratio = available_ram
+        else:
+            ratio = int(available_ram / available_vcpus)
+        weight_ram = sigmoid(available_ram / self.memory_mb)
+        weight_vcpus = sigmoid(available_vcpus / self.vcpus)
+        angle = atan(self._common_ratio) - atan(ratio)
         return angle * (weight_ram + weight_vcpus)
 
+    def fits(self, server):
+        """fits
+
+        Returns True if there are enough available resources to host a given VM.
+        """
+        return server.ram <= self.available_ram and \
+            server.vcpus <= self.available_vcpus
+
     def pop(self):
         """pop
 
         Returns all servers and removes them from this hypervisor.
         """
         servers = self.servers
-        self.servers = []
+        for server in servers:
+            self._detach(server)
+            self._record(server, False)
         return servers
 
+    def has_server(self, server):
+        """has_server
+
+        Returns True if a given VM is hosted on this hypervisor.
+        """
+        return server.id in self._servers
+
     def add_server(self, server, force=False):
         """add_server
 
         Adds an OpenStack instance to the Hypervisor. Returns True if succeeded,
         else returns False.
         """
-        if not force and (server.ram > self.available_ram or
-                          server.vcpus > self.available_vcpus):
+        if self.has_server(server):
+            logging.error('Server %s is already hosted on %s', server.name,
+                          self)
+            return False
+        if not force and not self.fits(server):
             return False
         logging.debug('Adding %s to %s', server.name, self)
-        self.servers.append(server)
+        self._attach(server)
+        self._record(server, True)
         return True
 
     def remove_server(self, server):
@@ -274,11 +538,23 @@ class CustomHypervisor(Hypervisor):
         otherwise (e.g. if the VM wasn't found on this server) returns False.
         """
         logging.debug('Removing %s from %s', server.name, self)
-        filtered_servers = [s for s in self.servers if not s == server]
-        if len(filtered_servers) == len(self.servers) - 1:
-            self.servers = filtered_servers
-            return True
-        else:
-            logging.error('Error while removing server %s: VM count %i -> %i',
-                          server.name, len(self.servers), len(filtered_servers))
+        if not self.has_server(server):
+            logging.error('Error while removing server %s: not hosted on %s',
+                          server.name, self)
             return False
+        self._detach(server)
+        self._record(server, False)
+        return True
+
+def _net_changes(changes):
+    """_net_changes
+
+    Takes a sequence of journal entries (tuples of a VM and whether it was added
+    or removed) and returns the entries which have a net effect, in order of
+    first appearance.
+    """
+    net = {}
+    for server, added in changes:
+        delta = net.get(server.id, (server, 0))[1] + (1 if added else -1)
+        net[server.id] = (server, delta)
+    return [(server, delta > 0) for server, delta in net.values() if delta]
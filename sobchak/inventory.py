@@ -1,8 +1,25 @@
 import logging
-from sobchak.helper import get_object_by_id
+import random
+import time
+from bisect import bisect_right
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from sobchak.annealing import Annealer, MAX_MOVED, MIGRATION_COST, STEPS
+from sobchak.capacity import CapacityIndex
+from sobchak.helper import get_object_by_id, ObjectIndex
+from sobchak.engine import ScoringEngine
 from sobchak.hypervisor import CustomHypervisor
 from sobchak.server import CustomServer
 from sobchak.migration import Migration
+from sobchak.repartition import MAX_NODES, repartition
+
+# Statuses of servers which no longer use any hypervisor resources
+GONE_STATUSES = ['DELETED', 'SHELVED_OFFLOADED']
+
+# Default number of seconds the `changes-since` marker is set back, since it is
+# taken from the local clock rather than the clock of the Nova API
+CHANGES_SINCE_MARGIN = 300
 
 class Inventory(object):
     """Inventory
@@ -17,6 +34,41 @@ class Inventory(object):
         self._hypervisors = []
         self._vms = []
         self._flavors = []
+        self._hypervisor_list = []
+        self._fetched = False
+        self._changes_since = None
+        self._hypervisor_index = ObjectIndex()
+        self._server_index = ObjectIndex()
+        self._flavor_index = ObjectIndex()
+        self._missing_flavors = set()
+        self._ratios = Counter()
+        self._common_ratio = None
+        self._engine = None
+        self._capacity_index = None
+
+    @classmethod
+    def from_hypervisors(cls, hypervisors, config={}):
+        """from_hypervisors
+
+        Returns an inventory containing the given hypervisors and the VMs they
+        host, e.g. a partition of another inventory. The hypervisors steer
+        towards the most common ratio amongst their own VMs and their current
+        state is saved as the initial snapshot.
+        """
+        inventory = cls(None, config)
+        inventory._hypervisors = list(hypervisors)
+        inventory._hypervisor_index = ObjectIndex(inventory._hypervisors)
+        inventory._vms = [vm for h in inventory._hypervisors
+                          for vm in h.servers]
+        inventory._server_index = ObjectIndex(inventory._vms)
+        inventory._fetched = True
+        inventory._count_ratios()
+        if inventory._ratios:
+            for hypervisor in inventory._hypervisors:
+                hypervisor.common_ratio = inventory.common_ratio
+            inventory._calculate_divergences(inventory._vms)
+        inventory.snapshot(validate=False)
+        return inventory
 
     def to_dict(self):
         """to_dict
@@ -31,11 +83,13 @@ class Inventory(object):
     def snapshot(self, validate=True):
         """snapshot
 
-        Saves a snapshot of the current inventory.
+        Saves a snapshot of the current inventory and returns its index.
         """
         logging.debug('Taking snapshot')
+        index = None
         for hypervisor in self.hypervisors:
-            hypervisor.snapshot(validate)
+            index = hypervisor.snapshot(validate)
+        return index
 
     def use_snapshot(self, index=-1, validate=True):
         """use_snapshot
@@ -55,13 +109,18 @@ class Inventory(object):
         hypervisors.
         """
         if not self._hypervisors:
-            logging.info('Fetching hypervisor info')
+            if not self._fetched:
+                self._fetch()
             self._hypervisors = [
                 CustomHypervisor(h, self.common_ratio, self._config)
-                for h in self._client.hypervisors.list()]
+                for h in self._hypervisor_list]
+            self._hypervisor_list = []
+            self._hypervisor_index = ObjectIndex(self._hypervisors)
+            self._calculate_divergences(self.vms)
 
             for vm in self.vms:
-                hypervisor = get_object_by_id(self._hypervisors, vm.hypervisor)
+                hypervisor = get_object_by_id(self._hypervisor_index,
+                                              vm.hypervisor)
                 if hypervisor:
                     hypervisor.add_server(vm, force=True)
                 else:
@@ -78,32 +137,403 @@ class Inventory(object):
 
         Returns a list of VM's as CustomServer objects.
         """
-        def _fetch_vms(client, chunksize=1000):
-            """_fetch_vms
-
-            Fetches and returns a list of all servers using pagination.
-            """
-            vms = []
-            listmarker = None
-            while True:
-                new_vms = client.servers.list(
-                    search_opts={'all_tenants': True},
-                    limit=chunksize,
-                    marker=listmarker)
-                vms.extend(new_vms)
-                if len(new_vms) < chunksize:
-                    break
+        if not self._fetched:
+            self._fetch()
+
+        return self._vms
+
+    def _fetch(self):
+        """_fetch
+
+        Fetches the hypervisors and VMs concurrently, doing at most
+        `fetch_workers` (see the configuration file) requests in parallel.
+        """
+        logging.info('Fetching hypervisor and VM info')
+        self._changes_since = self._marker()
+        workers = self._config.get('fetch_workers', 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            hypervisors = executor.submit(self._fetch_hypervisors)
+            self._vms = self._fetch_vms(executor)
+            self._hypervisor_list = hypervisors.result()
+
+        self._server_index = ObjectIndex(self._vms)
+        self._count_ratios()
+        self._fetched = True
+        logging.info('Fetched %i hypervisors and %i VMs',
+                     len(self._hypervisor_list), len(self._vms))
+
+    def _fetch_hypervisors(self, chunksize=1000):
+        """_fetch_hypervisors
+
+        Fetches and returns a list of all hypervisors. Since Nova API
+        microversion 2.33 the hypervisor list is paginated.
+        """
+        version = getattr(self._client, 'api_version', None)
+        if not version or (version.ver_major, version.ver_minor) < (2, 33):
+            return self._client.hypervisors.list()
+
+        hypervisors = []
+        marker = None
+        while True:
+            new_hypervisors = self._client.hypervisors.list(limit=chunksize,
+                                                            marker=marker)
+            hypervisors.extend(new_hypervisors)
+            if len(new_hypervisors) < chunksize:
+                return hypervisors
+            marker = hypervisors[-1].id
+
+    def _fetch_servers(self, executor, search_opts, chunksize=1000):
+        """_fetch_servers
+
+        Fetches the servers matching the given search options using pagination
+        and yields them. Every page is yielded as soon as it arrives, while the
+        next page is already being fetched.
+        """
+        def _fetch_page(marker):
+            return self._client.servers.list(
+                search_opts=search_opts,
+                limit=chunksize,
+                marker=marker)
+
+        page = executor.submit(_fetch_page, None)
+        while page:
+            servers = page.result()
+            page = None
+            if len(servers) == chunksize:
+                page = executor.submit(_fetch_page, servers[-1].id)
+
+            for server in servers:
+                yield server
+
+    def _fetch_vms(self, executor, chunksize=1000):
+        """_fetch_vms
+
+        Fetches all servers and returns them as a list of CustomServer objects.
+        """
+        vms = []
+        for server in self._fetch_servers(executor, {'all_tenants': True},
+                                          chunksize):
+            if server.status in GONE_STATUSES:
+                continue
+            vm = self._create_server(server)
+            if vm:
+                vms.append(vm)
+        return vms
+
+    def _create_server(self, server):
+        """_create_server
+
+        Returns a CustomServer object for a given server. When the server does
+        not contain its flavor's resources (Nova API microversions before 2.47),
+        the flavor is looked up; flavors which are not in the flavor list (e.g.
+        deleted ones) are fetched separately. Returns None if the flavor could
+        not be found.
+        """
+        flavor = server._info['flavor']
+        if not ('ram' in flavor and 'vcpus' in flavor) and \
+                flavor['id'] not in self.flavor_index and \
+                flavor['id'] not in self._missing_flavors:
+            try:
+                self._flavor_index.add(self._client.flavors.get(flavor['id']))
+            except Exception as e:
+                logging.debug('Could not fetch flavor %s: %s', flavor['id'], e)
+                self._missing_flavors.add(flavor['id'])
+
+        try:
+            return CustomServer(server, self._flavor_index)
+        except LookupError as e:
+            logging.warning('Skipping server %s: %s', server.id, e)
+            return None
+
+    def _count_ratios(self):
+        """_count_ratios
+
+        (Re)builds the histogram of the ratios of all (small) VMs.
+        """
+        self._ratios = Counter([vm.ratio for vm in self._vms
+                                if self._is_small(vm)])
+        self._common_ratio = None
+
+    def _is_small(self, vm):
+        """_is_small
+
+        Returns True if a VM is small enough to be taken into account when
+        determining the most common ratio (see `common_ratio_max_ram` and
+        `common_ratio_max_vcpus` in the configuration file).
+        """
+        max_ram = self._config.get('common_ratio_max_ram')
+        max_vcpus = self._config.get('common_ratio_max_vcpus')
+        return (max_ram is None or vm.ram <= max_ram) and \
+            (max_vcpus is None or vm.vcpus <= max_vcpus)
+
+    def _register_vms(self, vms):
+        """_register_vms
+
+        Adds VMs to the inventory and its ratio histogram.
+        """
+        for vm in vms:
+            self.vms.append(vm)
+            self._server_index.add(vm)
+            if self._is_small(vm):
+                self._ratios[vm.ratio] += 1
+        self._update_common_ratio()
+        self._calculate_divergences(vms)
+
+    def _unregister_vms(self, vms):
+        """_unregister_vms
+
+        Removes VMs from the inventory and its ratio histogram.
+        """
+        vm_ids = set([vm.id for vm in vms])
+        self._vms = [v for v in self.vms if v.id not in vm_ids]
+        for vm in vms:
+            self._server_index.remove(vm)
+            if self._is_small(vm):
+                self._ratios[vm.ratio] -= 1
+                if not self._ratios[vm.ratio]:
+                    del self._ratios[vm.ratio]
+        self._update_common_ratio()
+
+    def _update_common_ratio(self):
+        """_update_common_ratio
+
+        Recalculates the most common ratio and passes it on to the hypervisors
+        if it changed.
+        """
+        previous = self._common_ratio
+        if previous is None:
+            return
+        self._common_ratio = None
+        common_ratio = self.common_ratio
+        if common_ratio == previous:
+            return
+        logging.info('Most common ratio changed from %i to %i', previous,
+                     common_ratio)
+        for hypervisor in self._hypervisors:
+            hypervisor.common_ratio = common_ratio
+        self._calculate_divergences(self._vms)
+        self._engine = None
+        self._capacity_index = None
+
+    def _calculate_divergences(self, vms):
+        """_calculate_divergences
+
+        Calculates the divergence of the given VMs from the most common ratio,
+        so it's available as their `divergence` attribute.
+        """
+        if self._common_ratio is None:
+            return
+        for vm in vms:
+            vm.calculate_divergence(self._common_ratio)
+
+    def _marker(self):
+        """_marker
+
+        Returns the `changes-since` marker for the next refresh: the current
+        time minus `changes_since_margin` seconds (see the configuration
+        file), so changes are not missed when the local clock is ahead of the
+        Nova API. Servers which are fetched again but did not change are
+        skipped by the refresh.
+        """
+        return _timestamp(self._config.get('changes_since_margin',
+                                           CHANGES_SINCE_MARGIN))
+
+    def refresh(self):
+        """refresh
+
+        Brings the initial state of the inventory up to date without fetching
+        everything again: the hypervisors are polled and only the servers which
+        changed since the last fetch or refresh are fetched (using the
+        `changes-since` filter), so VMs which were created, deleted, moved or
+        resized are applied as deltas. All snapshots are discarded and the
+        refreshed state becomes the initial snapshot.
+
+        Returns a list of the hypervisors which changed.
+        """
+        if not self._hypervisors:
+            self.hypervisors
+            return list(self._hypervisors)
+
+        logging.info('Refreshing inventory (changes since %s)',
+                     self._changes_since)
+        self.use_snapshot(0, validate=False)
+        changes_since = self._marker()
+        changed = {}
+
+        workers = self._config.get('fetch_workers', 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            hypervisor_list = executor.submit(self._fetch_hypervisors)
+            servers = list(self._fetch_servers(
+                executor, {'all_tenants': True,
+                           'changes-since': self._changes_since}))
+            hypervisor_list = hypervisor_list.result()
+
+        # Apply the polled hypervisors
+        hypervisor_ids = set()
+        for h in hypervisor_list:
+            hypervisor_ids.add(h.id)
+            hypervisor = self._hypervisor_index.get_by_id(h.id)
+            if not hypervisor:
+                hypervisor = CustomHypervisor(h, self.common_ratio,
+                                              self._config)
+                logging.info('New hypervisor: %s', hypervisor)
+                self._hypervisors.append(hypervisor)
+                self._hypervisor_index.add(hypervisor)
+                changed[hypervisor.id] = hypervisor
+            elif hypervisor.update(h):
+                logging.info('Hypervisor changed: %s', hypervisor)
+                changed[hypervisor.id] = hypervisor
+        removed_vms = []
+        for hypervisor in list(self._hypervisors):
+            if hypervisor.id not in hypervisor_ids:
+                logging.info('Hypervisor disappeared: %s', hypervisor)
+                self._hypervisors.remove(hypervisor)
+                self._hypervisor_index.remove(hypervisor)
+                changed.pop(hypervisor.id, None)
+                removed_vms.extend(hypervisor.servers)
+
+        # The VMs of disappeared hypervisors are gone as well; unregister them
+        # first, so changed servers are not matched against them
+        gone_vms = len(removed_vms)
+        if removed_vms:
+            self._unregister_vms(removed_vms)
+
+        # Apply the changed servers
+        added_vms = []
+        for server in servers:
+            vm = None
+            if server.status not in GONE_STATUSES:
+                vm = self._create_server(server)
+            existing = self._server_index.get_by_id(server.id)
+            if existing and vm and \
+                    (existing.hypervisor, existing.ram, existing.vcpus) == \
+                    (vm.hypervisor, vm.ram, vm.vcpus):
+                existing.status = vm.status
+                continue
+            if existing:
+                removed_vms.append(existing)
+                hypervisor = self._hypervisor_index.get(existing.hypervisor)
+                if hypervisor and hypervisor.remove_server(existing):
+                    changed[hypervisor.id] = hypervisor
+            if vm:
+                added_vms.append(vm)
+                hypervisor = self._hypervisor_index.get(vm.hypervisor)
+                if hypervisor:
+                    hypervisor.add_server(vm, force=True)
+                    changed[hypervisor.id] = hypervisor
                 else:
-                    listmarker = vms[-1].id
-            return vms
+                    logging.warning('Unknown hypervisor for %s (status: %s)',
+                                    vm, vm.status)
+        self._unregister_vms(removed_vms[gone_vms:])
+        self._register_vms(added_vms)
+        logging.info('Refreshed %i servers: %i removed and %i added',
+                     len(servers), len(removed_vms), len(added_vms))
+
+        # The resources reported by OpenStack may have been polled at a slightly
+        # different moment than the servers
+        for hypervisor in self._hypervisors:
+            if not hypervisor.resources_match():
+                logging.info('Resources of %s are out of sync, using calculated'
+                             ' resources', hypervisor)
+                hypervisor.adopt_calculated_resources()
+            hypervisor.reset_snapshots()
+
+        self._changes_since = changes_since
+        self._engine = None
+        self._capacity_index = None
+        self.snapshot(validate=False)
+        return list(changed.values())
+
+    def revalidate(self, migrations):
+        """revalidate
+
+        Replays a list of migrations which was generated before the last
+        refresh on the initial state and returns the migrations which are still
+        possible. Migrations of VMs or hypervisors which disappeared, or which
+        no longer fit, are dropped. The resulting state is saved as a snapshot.
+        """
+        self.use_snapshot(0, validate=False)
+        valid_migrations = []
+        for migration in migrations:
+            server = self._server_index.get_by_id(migration.server.id)
+            source = self._hypervisor_index.get_by_id(migration.source.id)
+            destination = self._hypervisor_index.get_by_id(
+                migration.destination.id)
+            if not (server and source and destination and source.enabled and
+                    destination.enabled and source.has_server(server)):
+                logging.info('Dropping migration of %s', migration.server)
+                continue
+            source.remove_server(server)
+            if not destination.add_server(server):
+                logging.info('Dropping migration of %s', migration.server)
+                source.add_server(server, force=True)
+                continue
+            valid_migrations.append(Migration(server, source, destination))
 
-        if not self._vms:
-            logging.info('Fetching VM info')
-            self._vms = [CustomServer(vm, self.flavors)
-                         for vm in _fetch_vms(self._client)
-                         if vm.status != 'SHELVED_OFFLOADED']
+        logging.info('%i of %i migrations are still valid',
+                     len(valid_migrations), len(migrations))
+        self.snapshot(validate=False)
+        return valid_migrations
 
-        return self._vms
+    @property
+    def partitions(self):
+        """partitions
+
+        Returns a dictionary containing the hypervisors of every partition of
+        the inventory. Migrations never cross partitions; see `partitions` in
+        the configuration file. Without partitioning, all hypervisors are in a
+        single partition.
+        """
+        setting = self._config.get('partitions')
+        if not setting:
+            return {'all': self.hypervisors}
+
+        if isinstance(setting, dict):
+            hosts = {host: name for name, hostnames in setting.items()
+                     for host in hostnames}
+            default = 'default'
+        elif setting in ['aggregate', 'availability_zone']:
+            hosts = self._fetch_aggregates(setting)
+            default = 'nova' if setting == 'availability_zone' else 'default'
+        else:
+            logging.error('Unknown partitioning: %s', setting)
+            exit(1)
+
+        partitions = {}
+        for hypervisor in self.hypervisors:
+            # Aggregates contain service hosts, which are usually the short
+            # hostnames of the hypervisors
+            name = hosts.get(hypervisor.name,
+                             hosts.get(hypervisor.name.split('.')[0], default))
+            partitions.setdefault(name, []).append(hypervisor)
+        return partitions
+
+    def _fetch_aggregates(self, setting):
+        """_fetch_aggregates
+
+        Fetches the host aggregates and returns a dictionary containing the
+        partition of every host in an aggregate: the names of its aggregates or
+        its availability zone, depending on the given setting.
+        """
+        try:
+            aggregates = self._client.aggregates.list()
+        except Exception as e:
+            logging.error('Could not fetch host aggregates: %s', e)
+            exit(1)
+
+        memberships = {}
+        for aggregate in aggregates:
+            if setting == 'availability_zone':
+                name = aggregate.availability_zone
+            else:
+                name = aggregate.name
+            if not name:
+                continue
+            for host in aggregate.hosts:
+                memberships.setdefault(host, set()).add(name)
+
+        return {host: '+'.join(sorted(names))
+                for host, names in memberships.items()}
 
     @property
     def enabled_hypervisors(self):
@@ -121,12 +551,7 @@ class Inventory(object):
         and has a negative score, so it can help. Returns None if no hypervisors
         fit that profile.
         """
-        candidate_hypervisors = [h for h in self.enabled_hypervisors
-                                 if h.score < 0]
-        if candidate_hypervisors:
-            return max(candidate_hypervisors, key=lambda h: h.divergence[0])
-        else:
-            return None
+        return self.engine.left_divergent()
 
     @property
     def right_divergent(self):
@@ -136,33 +561,104 @@ class Inventory(object):
         and has a positive score, so it can help. Returns None if no hypervisors
         fit that profile.
         """
-        candidate_hypervisors = [h for h in self.enabled_hypervisors
-                                 if h.score > 0]
-        if candidate_hypervisors:
-            return max(candidate_hypervisors, key=lambda h: h.divergence[1])
-        else:
-            return None
+        return self.engine.right_divergent()
+
+    @property
+    def engine(self):
+        """engine
+
+        Returns a ScoringEngine which evaluates the scores and divergence of all
+        hypervisors at once.
+        """
+        if not self._engine:
+            self._engine = ScoringEngine(self.hypervisors, self.common_ratio)
+
+        return self._engine
+
+    @property
+    def capacity_index(self):
+        """capacity_index
+
+        Returns a CapacityIndex of all enabled hypervisors, which finds the
+        hypervisor that fits a VM the tightest.
+        """
+        if not self._capacity_index:
+            self._capacity_index = CapacityIndex(self.hypervisors,
+                                                 self.common_ratio)
+
+        return self._capacity_index
 
     @property
     def common_ratio(self):
         """common_ratio
 
-        Returns the most common ratio amongst all VMs.
+        Returns the most common ratio amongst all (small) VMs. The ratios are
+        counted once when the VMs are fetched and kept up to date when VMs are
+        added or removed.
         """
-        ratios = [vm.ratio for vm in self.vms]
-        return max(ratios, key=ratios.count)
+        if self._common_ratio is None:
+            if not self.vms or not self._ratios:
+                logging.error('Could not determine the most common ratio')
+                exit(1)
+            self._common_ratio = self._ratios.most_common(1)[0][0]
+
+        return self._common_ratio
 
     @property
     def flavors(self):
         """flavors
 
-        Returns a list of Flavors.
+        Returns a list of Flavors. The flavors are only fetched when needed, as
+        recent Nova API microversions include the flavor's resources in the
+        server details.
         """
         if not self._flavors:
             self._flavors = self._client.flavors.list(is_public=None)
 
         return self._flavors
 
+    @property
+    def fetched_flavors(self):
+        """fetched_flavors
+
+        Returns the Flavors which were fetched so far, without fetching them;
+        empty when all servers contained their flavor's resources.
+        """
+        return list(self._flavor_index) or list(self._flavors)
+
+    @property
+    def flavor_index(self):
+        """flavor_index
+
+        Returns an ObjectIndex of all Flavors.
+        """
+        if not self._flavor_index:
+            self._flavor_index = ObjectIndex(self.flavors)
+
+        return self._flavor_index
+
+    @property
+    def hypervisor_index(self):
+        """hypervisor_index
+
+        Returns an ObjectIndex of all hypervisors.
+        """
+        if not self._hypervisor_index:
+            self._hypervisor_index = ObjectIndex(self.hypervisors)
+
+        return self._hypervisor_index
+
+    @property
+    def server_index(self):
+        """server_index
+
+        Returns an ObjectIndex of all VMs.
+        """
+        if not self._server_index:
+            self._server_index = ObjectIndex(self.vms)
+
+        return self._server_index
+
     def _validate_migrations(self, migrations):
         """_validate_migrations
 
@@ -197,29 +693,58 @@ class Inventory(object):
 
         logging.info('Validated migration list')
 
+    def _validate_new_migrations(self, migrations, validated_migrations,
+                                 index):
+        """_validate_new_migrations
+
+        Validates a list of migrations which extends (or rewrites the end of) a
+        list of migrations which was validated before and resulted in the
+        snapshot with the given index. Only the migrations after the common
+        beginning of both lists are checked, like `_validate_migrations` does:
+        the other validated migrations are rolled back and the new ones are
+        replayed.
+        """
+        self.use_snapshot(index, validate=False)
+
+        prefix = 0
+        for validated, migration in zip(validated_migrations, migrations):
+            if validated.server != migration.server or \
+                    validated.source is not migration.source or \
+                    validated.destination is not migration.destination:
+                break
+            prefix += 1
+
+        for migration in reversed(validated_migrations[prefix:]):
+            assert migration.destination.remove_server(migration.server)
+            assert migration.source.add_server(migration.server, force=True)
+
+        for migration in migrations[prefix:]:
+            assert migration.source.enabled
+            assert migration.destination.enabled
+            assert migration.source.remove_server(migration.server)
+            assert migration.destination.add_server(migration.server)
+
+        logging.info('Validated %i new migrations', len(migrations) - prefix)
+
     def _increase_buffer(self, hypervisor, skip_hypervisor_ids=[],
                          skip_server_ids=[]):
         """_increase_buffer
 
         Returns a migration which will temporarily give a given hypervisor extra
         available resources. Does not use the hypervisors given in `skip` as a
-        buffer.
+        buffer. The largest VM which fits on another hypervisor is migrated to
+        the hypervisor which it fits the tightest.
         """
-        potential_buffers = [h for h in self.enabled_hypervisors
-                             if h.id not in skip_hypervisor_ids and
-                             h.id != hypervisor.id]
+        exclude = set(skip_hypervisor_ids)
+        exclude.add(hypervisor.id)
         servers = [s for s in hypervisor.servers if s.id not in skip_server_ids]
 
-        buffers = reversed(sorted(potential_buffers,
-                                  key=lambda h: h.available_vcpus * h.available_ram))
-
-        sorted_servers = reversed(sorted(servers, key=lambda s: s.length))
-
-        for buff in buffers:
-            for server in sorted_servers:
-                if buff.add_server(server):
-                    assert hypervisor.remove_server(server)
-                    return Migration(server, hypervisor, buff)
+        for server in reversed(sorted(servers, key=lambda s: s.length)):
+            buff = self.capacity_index.find(server, exclude)
+            if buff:
+                assert buff.add_server(server)
+                assert hypervisor.remove_server(server)
+                return Migration(server, hypervisor, buff)
 
         logging.warning('Could not find available resources to migrate!')
         return None
@@ -257,13 +782,30 @@ class Inventory(object):
         need to be done to realize this (as some migrations will not be possible
         due to insufficient available resources). Returns a list of Migration
         objects or an empty list if it's not possible.
+
+        The needed migrations are processed as a work queue, to which the
+        reverse migrations of buffer migrations are added. The number of pending
+        migrations and the destinations of every VM are indexed, so planning
+        takes linear time.
         """
         migrations = []
-        skip_servers = []
+        queue = deque(needed_migrations)
+        pending = Counter()
+        destinations = {}
+        skip_servers = Counter()
+
+        def _enqueue(migration):
+            pending[migration.server.id] += 1
+            destinations[migration.server.id] = migration.destination
 
         for migration in needed_migrations:
-            if migration.server in skip_servers:
-                skip_servers.remove(migration.server)
+            _enqueue(migration)
+
+        while queue:
+            migration = queue.popleft()
+            if skip_servers[migration.server.id]:
+                skip_servers[migration.server.id] -= 1
+                pending[migration.server.id] -= 1
                 continue
             new_migrations = self._try_migration(migration)
             if not new_migrations:
@@ -272,36 +814,27 @@ class Inventory(object):
                 return []
             new_migration, post_migrations = new_migrations
             migrations.extend(new_migration)
+            pending[migration.server.id] -= 1
             for post_migration in post_migrations:
-                if post_migration.server in [m.server for m in
-                                             needed_migrations if m not in migrations]:
-                    skip_servers.append(post_migration.server)
-                    destinations = [m.destination for m in needed_migrations
-                                    if m.server == post_migration.server]
-                    assert len(destinations) == 1
-                    post_migration.destination = destinations[0]
-                needed_migrations.append(post_migration)
+                if pending[post_migration.server.id]:
+                    # The VM still has to be migrated, so move it straight to
+                    # its destination and skip its pending migration
+                    skip_servers[post_migration.server.id] += 1
+                    post_migration.destination = \
+                        destinations[post_migration.server.id]
+                queue.append(post_migration)
+                _enqueue(post_migration)
 
         return migrations
 
-    def _score_with_vm(self, hypervisor, vm):
-        """_score_with_vm
-
-        Returns the score a hypervisor would have if it hosted a given VM.
-        """
-        if not hypervisor.add_server(vm):
-            return hypervisor.score
-        else:
-            score = hypervisor.score
-            assert hypervisor.remove_server(vm)
-            return score
-
-    def _mix_hypervisors(self, subject, improvement):
+    @staticmethod
+    def _mix_hypervisors(subject, improvement, max_nodes=MAX_NODES):
         """_mix_hypervisors
 
         Takes two hypervisors (a `subject` which is to be improved and an
         `improvement` which has the divergence which enables the improvement)
-        and mixes their VMs to improve the overall score.
+        and mixes their VMs to improve the overall score (see
+        `sobchak.repartition`; at most `max_nodes` partitions are examined).
 
         Returns a list of migrations if the combined score is lowered, otherwise
         returns None. Also returns None if the VMs do not fit on the two
@@ -313,47 +846,207 @@ class Inventory(object):
         """
         logging.info('Mixing %s and %s', subject.name, improvement.name)
         score_before = abs(subject.score) + abs(improvement.score)
-        subject_vms = subject.pop()
-        improvement_vms = improvement.pop()
-        vms = subject_vms + improvement_vms
-
-        while vms:
-            best_vm = min(vms,
-                          key=lambda vm: abs(self._score_with_vm(subject, vm)))
-            if not subject.add_server(best_vm):
-                break
-            vms.remove(best_vm)
+        subject_vms = repartition(subject, improvement, max_nodes)
+        if subject_vms is None:
+            logging.warning('Could not fit VMs in hypervisors!')
+            return None
 
-        for vm in vms:
-            if not improvement.add_server(vm):
-                logging.warning('Could not fit VMs in hypervisors!')
-                subject.servers = subject_vms
-                improvement.servers = improvement_vms
-                return None
+        subject_vm_ids = set([vm.id for vm in subject_vms])
+        incoming = [vm for vm in improvement.servers
+                    if vm.id in subject_vm_ids]
+        outgoing = [vm for vm in subject.servers
+                    if vm.id not in subject_vm_ids]
+        for vm in incoming:
+            improvement.remove_server(vm)
+        for vm in outgoing:
+            subject.remove_server(vm)
+        for vm in incoming:
+            subject.add_server(vm, force=True)
+        for vm in outgoing:
+            improvement.add_server(vm, force=True)
 
         score_after = abs(subject.score) + abs(improvement.score)
         logging.info('Score from %f to %f', score_before, score_after)
         if score_after >= score_before:
-            subject.servers = subject_vms
-            improvement.servers = improvement_vms
+            for vm in incoming:
+                subject.remove_server(vm)
+            for vm in outgoing:
+                improvement.remove_server(vm)
+            for vm in incoming:
+                improvement.add_server(vm, force=True)
+            for vm in outgoing:
+                subject.add_server(vm, force=True)
             return None
 
-        return [Migration(s, improvement, subject) for s in subject.servers
-                if s not in subject_vms] + \
-               [Migration(s, subject, improvement) for s in improvement.servers
-                if s not in improvement_vms]
+        return [Migration(vm, improvement, subject) for vm in incoming] + \
+               [Migration(vm, subject, improvement) for vm in outgoing]
 
-    def optimize(self, migrations=[], iterations=3):
-        """optimize
+    def _merge_migrations(self, migrations):
+        """_merge_migrations
 
-        Generates and returns a list of migrations to improve Hypervisor
-        resource distribution.
+        Returns a compacted list of migrations, which must already have been
+        applied to the current state. Successive migrations of the same VM are
+        merged into one and migrations which end on their source are dropped.
+
+        Next, every chain of migrations of the same VM is collapsed into a
+        single migration (at the position of the last one) if the source has
+        enough available resources to host the VM until then. A chain which
+        ends on its source is dropped altogether.
         """
-        if iterations == 0:
-            return migrations
+        merged = []
+        for migration in migrations:
+            if merged and merged[-1].server == migration.server:
+                previous = merged.pop()
+                migration = Migration(migration.server, previous.source,
+                                      migration.destination)
+            if migration.source is not migration.destination:
+                merged.append(migration)
+
+        chains = {}
+        for i, migration in enumerate(merged):
+            chains.setdefault(migration.server.id, []).append(i)
+        if all(len(chain) == 1 for chain in chains.values()):
+            return merged
+
+        # Record the used resources of the destination of every migration
+        used = {}
+
+        def _used(hypervisor):
+            if hypervisor.id not in used:
+                used[hypervisor.id] = [hypervisor.used_ram,
+                                       hypervisor.used_vcpus]
+            return used[hypervisor.id]
+
+        def _move(server, source, destination, sign=1):
+            _used(source)[0] -= sign * server.ram
+            _used(source)[1] -= sign * server.vcpus
+            _used(destination)[0] += sign * server.ram
+            _used(destination)[1] += sign * server.vcpus
+
+        for migration in merged:
+            _move(migration.server, migration.source, migration.destination,
+                  sign=-1)
+
+        arrivals = {}
+        for i, migration in enumerate(merged):
+            ram, vcpus = _used(migration.destination)
+            indices, usage = arrivals.setdefault(migration.destination.id,
+                                                 ([], []))
+            indices.append(i)
+            usage.append([ram, vcpus])
+            _move(migration.server, migration.source, migration.destination)
+
+        dropped = set()
+        sources = {}
+        for chain in chains.values():
+            if len(chain) > 1 and \
+                    self._collapse_chain(merged, chain, arrivals, dropped):
+                dropped.update(chain[:-1])
+                sources[chain[-1]] = merged[chain[0]].source
+                if sources[chain[-1]] is merged[chain[-1]].destination:
+                    dropped.add(chain[-1])
+
+        compacted = []
+        for i, migration in enumerate(merged):
+            if i in dropped:
+                continue
+            if i in sources:
+                migration = Migration(migration.server, sources[i],
+                                      migration.destination)
+            compacted.append(migration)
+
+        if len(compacted) < len(migrations):
+            logging.info('Compacted %i migrations to %i', len(migrations),
+                         len(compacted))
+        return compacted
+
+    def _collapse_chain(self, migrations, chain, arrivals, dropped):
+        """_collapse_chain
+
+        Tries to collapse a chain of migrations of the same VM (a list of
+        indices in the list of migrations), which means the VM stays on its
+        source until the last migration of the chain. Returns True if every
+        hypervisor still has enough available resources at every arrival of a
+        VM; the used resources in `arrivals` are updated accordingly. Returns
+        False (and changes nothing) otherwise.
+        """
+        server = migrations[chain[0]].server
+        source = migrations[chain[0]].source
+
+        # The VM would otherwise be hosted on `location` between two migrations
+        segments = [(chain[j], chain[j+1], migrations[chain[j]].destination)
+                    for j in range(len(chain) - 1)]
+
+        def _arrivals(hypervisor, start, end):
+            indices, usage = arrivals.get(hypervisor.id, ([], []))
+            for k in range(bisect_right(indices, start), len(indices)):
+                if indices[k] >= end:
+                    break
+                if indices[k] not in dropped:
+                    yield indices[k], usage[k]
+
+        for start, end, location in segments:
+            if location is source:
+                continue
+            for i, (ram, vcpus) in _arrivals(source, start, end):
+                arriving = migrations[i].server
+                if int(source.ram_capacity - ram - server.ram) < \
+                        arriving.ram or \
+                        int(source.vcpus_capacity - vcpus - server.vcpus) < \
+                        arriving.vcpus:
+                    return False
+
+        for start, end, location in segments:
+            if location is source:
+                continue
+            for _, usage in _arrivals(source, start, end):
+                usage[0] += server.ram
+                usage[1] += server.vcpus
+            for _, usage in _arrivals(location, start, end):
+                usage[0] -= server.ram
+                usage[1] -= server.vcpus
+        return True
+
+    def _disjoint_pairs(self, limit, subject_ids=None):
+        """_disjoint_pairs
+
+        Returns up to `limit` subject/improvement pairs, chosen like `optimize`
+        chooses them, which do not share any hypervisor.
+        """
+        pairs = []
+        used = set()
+        for subject in self.engine.by_score():
+            if len(pairs) == limit:
+                break
+            if subject.id in used or \
+                    (subject_ids is not None and subject.id not in subject_ids):
+                continue
+
+            exclude = used | set([subject.id])
+            if subject.score < 0:
+                improvement = self.engine.right_divergent(exclude)
+            else:
+                improvement = self.engine.left_divergent(exclude)
+
+            if not improvement:
+                continue
+
+            pairs.append((subject, improvement))
+            used.update([subject.id, improvement.id])
+        return pairs
+
+    def _serial_step(self, migrations, subject_ids=None, max_migrations=None):
+        """_serial_step
+
+        Mixes the first subject/improvement pair which improves their combined
+        score and plans the needed migrations. Pairs which would make the plan
+        exceed `max_migrations` are skipped. Returns the extended list of
+        migrations, or None if no pair could be improved.
+        """
+        for subject in self.engine.by_score():
+            if subject_ids is not None and subject.id not in subject_ids:
+                continue
 
-        for subject in reversed(sorted(self.enabled_hypervisors,
-                                       key=lambda h: abs(h.score))):
             if subject.score < 0:
                 improvement = self.right_divergent
             else:
@@ -362,28 +1055,401 @@ class Inventory(object):
             if not improvement:
                 continue
 
-            needed_migrations = self._mix_hypervisors(subject, improvement)
+            needed_migrations = self._mix_hypervisors(
+                subject, improvement, self._config.get('mix_max_nodes',
+                                                       MAX_NODES))
             self.use_snapshot(validate=False)
             if needed_migrations:
-                migrations.extend(self._plan_migrations(needed_migrations))
+                new_migrations = self._within_budget(
+                    migrations, self._plan_migrations(needed_migrations),
+                    max_migrations)
+                if new_migrations is None:
+                    self.use_snapshot(validate=False)
+                    continue
 
                 # Final optimization; merge successive migrations of the same VM
-                optimizing = True
-                while optimizing:
-                    optimizing = False
-                    for i in range(len(migrations) - 1):
-                        if migrations[i].server == migrations[i+1].server:
-                            optimizing = True
-                            migrations = migrations[:i] + \
-                                [Migration(migrations[i].server,
-                                           migrations[i].source,
-                                           migrations[i+1].destination)] + \
-                                migrations[i+2:]
-                            break
-
-                self.snapshot(validate=False)
-                self._validate_migrations(migrations)
-                return self.optimize(migrations=migrations,
-                                     iterations=iterations-1)
+                return self._merge_migrations(new_migrations)
+
+        return None
+
+    def _parallel_step(self, executor, workers, migrations, subject_ids=None,
+                       max_migrations=None):
+        """_parallel_step
+
+        Mixes up to `workers` disjoint subject/improvement pairs on a process
+        pool and plans the needed migrations. The results are planned in the
+        order of the pairs, so the outcome does not depend on the timing of the
+        worker processes; pairs which would make the plan exceed
+        `max_migrations` are skipped. Returns the extended list of migrations,
+        or None if no pair could be improved.
+        """
+        pairs = self._disjoint_pairs(workers, subject_ids)
+        if not pairs:
+            return None
+
+        logging.info('Mixing %i pairs of hypervisors', len(pairs))
+        max_nodes = self._config.get('mix_max_nodes', MAX_NODES)
+        results = executor.map(_mix_pair, [(s.clone(), i.clone(), max_nodes)
+                                           for s, i in pairs])
+        migrations = list(migrations)
+        planned = False
+        for (subject, improvement), result in zip(pairs, results):
+            if not result:
+                continue
+            hypervisors = {subject.id: subject, improvement.id: improvement}
+            vms = {vm.id: vm for vm in subject.servers + improvement.servers}
+            needed_migrations = [
+                Migration(vms[vm_id], hypervisors[source_id],
+                          hypervisors[destination_id])
+                for vm_id, source_id, destination_id in result]
+            new_migrations = self._plan_migrations(needed_migrations)
+            if not new_migrations:
+                continue
+            new_migrations = self._within_budget(migrations, new_migrations,
+                                                 max_migrations)
+            if new_migrations is None:
+                self.use_snapshot(validate=False)
+                continue
+            migrations = new_migrations
+            self.snapshot(validate=False)
+            planned = True
+
+        if not planned:
+            return None
+
+        # Final optimization; merge successive migrations of the same VM
+        return self._merge_migrations(migrations)
+
+    def _within_budget(self, migrations, new_migrations, max_migrations):
+        """_within_budget
 
+        Returns the list of migrations extended with the new (already applied)
+        migrations, merged if needed to stay within `max_migrations`, or None
+        if the new migrations do not fit in that budget.
+        """
+        migrations = migrations + new_migrations
+        if max_migrations is None or len(migrations) <= max_migrations:
+            return migrations
+
+        migrations = self._merge_migrations(migrations)
+        if len(migrations) > max_migrations:
+            logging.info('Skipping %i migrations, which exceed the maximum of '
+                         '%i', len(new_migrations), max_migrations)
+            return None
         return migrations
+
+    def _anneal_step(self, migrations, seed, subject_ids=None, deadline=None,
+                     max_migrations=None):
+        """_anneal_step
+
+        Searches for a better distribution of VMs over all enabled hypervisors
+        by simulated annealing and plans the needed migrations. The number of
+        steps, the temperature and the cost of a migration can be configured
+        with `anneal_steps`, `anneal_temperature` and `anneal_migration_cost`.
+        The whole plan contains at most as many migrations as the fraction
+        `anneal_max_moved` of the VMs (and `max_migrations`), so VMs are moved
+        within that limit. Returns the extended list of migrations, or None if
+        no better distribution was found.
+        """
+        max_moved = int(len(self.vms) * self._config.get('anneal_max_moved',
+                                                         MAX_MOVED))
+        if max_migrations is not None:
+            max_moved = min(max_moved, max_migrations)
+        max_moved -= len(migrations)
+        if max_moved <= 0:
+            return None
+
+        annealer = Annealer(self.hypervisors, seed,
+                            self._config.get('anneal_migration_cost',
+                                             MIGRATION_COST),
+                            subject_ids)
+        needed_migrations = annealer.run(
+            self._config.get('anneal_steps', STEPS),
+            self._config.get('anneal_temperature'), deadline, max_moved)
+        if not needed_migrations:
+            return None
+
+        new_migrations = self._plan_migrations(needed_migrations)
+        if not new_migrations:
+            return None
+
+        # Final optimization; merge successive migrations of the same VM
+        return self._merge_migrations(migrations + new_migrations)
+
+    def _optimize_partitions(self, partitions, migrations, subjects=None,
+                             **options):
+        """_optimize_partitions
+
+        Optimizes every partition independently, each with the most common
+        ratio amongst its own VMs. When `optimize_workers` is larger than 1,
+        the partitions are optimized in parallel on a process pool. The plans
+        are combined in the order of the partition names. What is left of a
+        maximum number of migrations after the given `migrations` is divided
+        amongst the partitions by their size (see `_divide`).
+        """
+        subject_ids = None
+        if subjects is not None:
+            subject_ids = set([h.id for h in subjects])
+
+        # Every partition is optimized on its own, serially
+        config = dict(self._config, partitions=None, optimize_workers=1)
+        names = sorted(partitions)
+        shares = None
+        if options.get('max_migrations') is not None:
+            shares = _divide(max(0, options['max_migrations'] -
+                                 len(migrations)),
+                             [len(partitions[name]) for name in names])
+        jobs = []
+        for i, name in enumerate(names):
+            # The copied hypervisors start from the current state rather than
+            # the reported one, so the combined plan is validated strictly
+            # here instead
+            partition_options = dict(options, strict_validate=False)
+            if shares is not None:
+                partition_options['max_migrations'] = shares[i]
+            jobs.append(([h.clone() for h in partitions[name]], config,
+                         subject_ids, partition_options))
+
+        workers = self._config.get('optimize_workers', 1)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_optimize_partition, jobs))
+        else:
+            results = [_optimize_partition(job) for job in jobs]
+
+        migrations = list(migrations)
+        for name, result in zip(names, results):
+            if result is None:
+                logging.warning('Skipping partition %s: it hosts no VMs to '
+                                'determine the most common ratio of', name)
+                continue
+
+            common_ratio, moves = result
+            logging.info('Partition %s: most common ratio %i, %i migrations',
+                         name, common_ratio, len(moves))
+            hypervisors = {h.id: h for h in partitions[name]}
+            vms = {vm.id: vm for h in partitions[name] for vm in h.servers}
+            for hypervisor in hypervisors.values():
+                hypervisor.common_ratio = common_ratio
+            for vm_id, source_id, destination_id in moves:
+                migration = Migration(vms[vm_id], hypervisors[source_id],
+                                      hypervisors[destination_id])
+                assert migration.source.remove_server(migration.server)
+                assert migration.destination.add_server(migration.server)
+                migrations.append(migration)
+
+        self._engine = None
+        self._capacity_index = None
+        self.snapshot(validate=False)
+        if options.get('strict_validate'):
+            self._validate_migrations(migrations)
+        return migrations
+
+    def optimize(self, migrations=None, iterations=3, subjects=None,
+                 time_budget=None, deadline=None, min_improvement=None,
+                 max_migrations=None, strict_validate=False, engine='pairs',
+                 seed=None):
+        """optimize
+
+        Generates and returns a list of migrations to improve Hypervisor
+        resource distribution. When a list of `subjects` is given, only those
+        hypervisors are improved (e.g. the ones which changed since the last
+        refresh).
+
+        Every iteration improves the plan of the previous one, until one of the
+        following limits is reached, after which the best plan so far is
+        returned:
+
+        * `iterations`: the number of iterations (None for no limit)
+        * `time_budget`: the number of seconds to spend (or an absolute
+          `deadline`, as a timestamp); checked before every iteration
+        * `min_improvement`: the minimal decrease of the total score of an
+          iteration; smaller improvements are kept, but end the optimization
+        * `max_migrations`: the maximum number of migrations; every iteration
+          only uses what is left of it, e.g. by skipping pairs of hypervisors
+          whose migrations do not fit
+
+        After every iteration, only the migrations which changed since the
+        previous iteration are validated. With `strict_validate`, the whole list
+        of migrations is replayed from the initial snapshot instead.
+
+        When `optimize_workers` (see the configuration file) is larger than 1,
+        every iteration mixes that many disjoint pairs of hypervisors in
+        parallel instead of a single pair. When the inventory is partitioned,
+        every partition is optimized independently.
+
+        With `engine` set to "anneal", every iteration moves and swaps VMs
+        across all enabled hypervisors by simulated annealing (see
+        `sobchak.annealing`) instead of mixing pairs. The random choices are
+        made with the given `seed`, so a seed and an inventory always result in
+        the same list of migrations (unless the time budget expires).
+        """
+        if migrations is None:
+            migrations = []
+
+        if time_budget is not None:
+            deadline = time.time() + time_budget
+
+        partitions = self.partitions
+        if len(partitions) > 1:
+            return self._optimize_partitions(
+                partitions, migrations, subjects, iterations=iterations,
+                deadline=deadline, min_improvement=min_improvement,
+                max_migrations=max_migrations, strict_validate=strict_validate,
+                engine=engine, seed=seed)
+
+        subject_ids = None
+        if subjects is not None:
+            subject_ids = set([h.id for h in subjects])
+
+        if engine == 'anneal':
+            seeds = random.Random(seed)
+            return self._optimize(
+                lambda m: self._anneal_step(m, seeds.getrandbits(32),
+                                            subject_ids, deadline,
+                                            max_migrations),
+                migrations, iterations, deadline, min_improvement,
+                max_migrations, strict_validate)
+
+        workers = self._config.get('optimize_workers', 1)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                return self._optimize(
+                    lambda m: self._parallel_step(executor, workers, m,
+                                                  subject_ids, max_migrations),
+                    migrations, iterations, deadline, min_improvement,
+                    max_migrations, strict_validate)
+
+        return self._optimize(lambda m: self._serial_step(m, subject_ids,
+                                                          max_migrations),
+                              migrations, iterations, deadline,
+                              min_improvement, max_migrations, strict_validate)
+
+    def _optimize(self, step, migrations, iterations, deadline,
+                  min_improvement, max_migrations, strict_validate):
+        """_optimize
+
+        Runs optimization steps until a limit is reached (see `optimize`) and
+        returns the best list of migrations. Progress is logged after every
+        iteration.
+        """
+        start = time.time()
+        score = self.engine.total_score
+        logging.info('Optimizing, total score: %f', score)
+        validated = self.snapshot(validate=False)
+
+        iteration = 0
+        while iterations is None or iteration < iterations:
+            if deadline is not None and time.time() >= deadline:
+                logging.info('Time budget expired')
+                break
+            if max_migrations is not None and \
+                    len(migrations) >= max_migrations:
+                logging.info('Maximum of %i migrations reached', max_migrations)
+                break
+
+            new_migrations = step(migrations)
+            if new_migrations is None:
+                logging.info('No more improvements found')
+                break
+
+            if strict_validate:
+                self._validate_migrations(new_migrations)
+            else:
+                self._validate_new_migrations(new_migrations, migrations,
+                                              validated)
+            iteration += 1
+            new_score = self.engine.total_score
+            logging.info('Iteration %i: total score from %f to %f, %i '
+                         'migrations (%.1f seconds)', iteration, score,
+                         new_score, len(new_migrations), time.time() - start)
+
+            if new_score > score or (max_migrations is not None and
+                                     len(new_migrations) > max_migrations):
+                logging.info('Discarding plan of iteration %i', iteration)
+                self.use_snapshot(validated, validate=False)
+                break
+
+            validated = self.snapshot(validate=False)
+            improvement = score - new_score
+            migrations = new_migrations
+            score = new_score
+            if min_improvement is not None and improvement < min_improvement:
+                logging.info('Improvement below %f, stopping',
+                             min_improvement)
+                break
+
+        return migrations
+
+def _mix_pair(pair):
+    """_mix_pair
+
+    Mixes a pair of (copied) hypervisors in a worker process; `pair` is a tuple
+    containing the subject, the improvement and the maximum number of nodes.
+    Returns the needed migrations as (VM ID, source ID, destination ID) tuples,
+    or None if mixing does not improve the score.
+    """
+    migrations = Inventory._mix_hypervisors(*pair)
+    if not migrations:
+        return None
+    return _migration_ids(migrations)
+
+def _optimize_partition(job):
+    """_optimize_partition
+
+    Optimizes a partition (a list of copied hypervisors) in a worker process.
+    Returns a tuple containing the most common ratio of the partition and the
+    migrations as (VM ID, source ID, destination ID) tuples, or None if the
+    partition hosts no VMs to determine the most common ratio of.
+    """
+    hypervisors, config, subject_ids, options = job
+    inventory = Inventory.from_hypervisors(hypervisors, config)
+    if not inventory._ratios:
+        return None
+
+    subjects = None
+    if subject_ids is not None:
+        subjects = [h for h in hypervisors if h.id in subject_ids]
+    migrations = inventory.optimize(subjects=subjects, **options)
+    return inventory.common_ratio, _migration_ids(migrations)
+
+def _divide(total, sizes):
+    """_divide
+
+    Divides a total amongst parts of the given sizes, proportionally by the
+    largest remainder method, so the shares add up to the total. When the total
+    allows it, every part gets at least one.
+    """
+    shares = [0] * len(sizes)
+    if total >= len(sizes):
+        shares = [1] * len(sizes)
+    rest = total - sum(shares)
+    weight = sum(sizes)
+    if not weight:
+        return shares
+
+    remainders = []
+    for i, size in enumerate(sizes):
+        share, remainder = divmod(rest * size, weight)
+        shares[i] += share
+        remainders.append((-remainder, i))
+    for _, i in sorted(remainders)[:total - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+def _migration_ids(migrations):
+    """_migration_ids
+
+    Returns a list of migrations as (VM ID, source ID, destination ID) tuples,
+    which are cheap to pass between processes.
+    """
+    return [(m.server.id, m.source.id, m.destination.id) for m in migrations]
+
+def _timestamp(margin=0):
+    """_timestamp
+
+    Returns the current UTC time minus `margin` seconds in the ISO 8601 format
+    the Nova API expects.
+    """
+    return (datetime.now(timezone.utc) - timedelta(seconds=margin)).strftime(
+        '%Y-%m-%dT%H:%M:%SZ')
@@ -0,0 +1,166 @@
+import gzip
+import json
+import logging
+
+FORMAT = 'sobchak-inventory'
+VERSION = 2
+SUPPORTED_VERSIONS = [1, 2]
+
+# Fields which are stored for every type of record, in order
+FIELDS = {
+    'hypervisor': ['id', 'hypervisor_hostname', 'status', 'vcpus', 'vcpus_used',
+                   'memory_mb', 'memory_mb_used'],
+    'flavor': ['id', 'name', 'ram', 'vcpus'],
+    'server': ['id', 'name', 'status', 'flavor_id', 'hypervisor', 'ram',
+               'vcpus'],
+}
+
+def _open(filename, mode):
+    """_open
+
+    Opens a (gzipped, if the filename ends with .gz) text file.
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't')
+    return open(filename, mode)
+
+def dump_inventory(inventory, filename):
+    """dump_inventory
+
+    Writes the hypervisors, flavors and VMs of an inventory as they were fetched
+    from the OpenStack API to a file, one JSON list per line. The first line
+    contains the format version and the fields of every type of record. Only
+    flavors which were already fetched are written, as the VMs contain their
+    own resources.
+    """
+    def _write(f, record_type, values):
+        f.write(json.dumps([record_type] + values) + '\n')
+
+    with _open(filename, 'w') as f:
+        f.write(json.dumps({'format': FORMAT, 'version': VERSION,
+                            'fields': FIELDS}) + '\n')
+        for hypervisor in inventory.hypervisors:
+            _write(f, 'hypervisor', [hypervisor.id, hypervisor.name,
+                                     hypervisor.status, hypervisor.vcpus,
+                                     hypervisor.vcpus_used,
+                                     hypervisor.memory_mb,
+                                     hypervisor.memory_mb_used])
+        for flavor in inventory.fetched_flavors:
+            _write(f, 'flavor', [flavor.id, flavor.name, flavor.ram,
+                                 flavor.vcpus])
+        for vm in inventory.vms:
+            _write(f, 'server', [vm.id, vm.name, vm.status, vm.flavor_id,
+                                 vm.hypervisor, vm.ram, vm.vcpus])
+    logging.info('Dumped inventory to %s', filename)
+
+class Resource(object):
+    """Resource
+
+    A minimal stand-in for a novaclient resource, containing the attributes of
+    an offline record.
+    """
+
+    __slots__ = ('manager', '_info')
+
+    def __init__(self, info):
+        self.manager = None
+        self._info = info
+
+    def __getattr__(self, key):
+        try:
+            return object.__getattribute__(self, '_info')[key]
+        except KeyError:
+            raise AttributeError(key)
+
+class ResourceManager(object):
+    """ResourceManager
+
+    Serves a list of resources like a novaclient resource manager does,
+    including pagination with `limit` and `marker`.
+    """
+
+    def __init__(self, resources):
+        self._resources = resources
+        self._positions = {r.id: i for i, r in enumerate(resources)}
+
+    def list(self, detailed=True, search_opts=None, marker=None, limit=None,
+             **kwargs):
+        """list
+
+        Returns a (page of the) list of resources.
+        """
+        start = 0
+        if marker is not None:
+            start = self._positions[marker] + 1
+        end = None if limit is None else start + limit
+        return self._resources[start:end]
+
+    def get(self, identifier):
+        """get
+
+        Returns the resource with the given ID.
+        """
+        try:
+            return self._resources[self._positions[identifier]]
+        except KeyError:
+            raise LookupError('{} not found'.format(identifier))
+
+class OfflineClient(object):
+    """OfflineClient
+
+    Replaces the Nova client by serving hypervisors, flavors and servers from
+    lists of records, e.g. loaded from an inventory dump.
+    """
+
+    def __init__(self, hypervisors, flavors, servers):
+        self.hypervisors = ResourceManager([Resource(h) for h in hypervisors])
+        self.flavors = ResourceManager([Resource(f) for f in flavors])
+        self.servers = ResourceManager([Resource({
+            'id': s['id'],
+            'name': s['name'],
+            'status': s['status'],
+            'flavor': self._flavor(s),
+            'OS-EXT-SRV-ATTR:hypervisor_hostname': s['hypervisor'],
+        }) for s in servers])
+
+    @staticmethod
+    def _flavor(server):
+        """_flavor
+
+        Returns the flavor of a server record like the Nova API does: only its
+        ID, or its resources as well when they were recorded.
+        """
+        if server.get('ram') is None:
+            return {'id': server['flavor_id']}
+        return {'id': server['flavor_id'], 'ram': server['ram'],
+                'vcpus': server['vcpus']}
+
+    @classmethod
+    def load(cls, filename):
+        """load
+
+        Returns an OfflineClient containing the records of an inventory dump.
+        """
+        records = {record_type: [] for record_type in FIELDS}
+        try:
+            with _open(filename, 'r') as f:
+                header = json.loads(f.readline())
+                if header.get('format') != FORMAT or \
+                        header.get('version') not in SUPPORTED_VERSIONS:
+                    raise ValueError('unsupported format {} (version {})'
+                                     .format(header.get('format'),
+                                             header.get('version')))
+                fields = header['fields']
+                for line in f:
+                    values = json.loads(line)
+                    record_type = values[0]
+                    records[record_type].append(
+                        dict(zip(fields[record_type], values[1:])))
+        except Exception as e:
+            logging.error('Could not load %s: %s', filename, e)
+            exit(1)
+
+        logging.info('Loaded %i hypervisors, %i flavors and %i servers from %s',
+                     len(records['hypervisor']), len(records['flavor']),
+                     len(records['server']), filename)
+        return cls(records['hypervisor'], records['flavor'], records['server'])
@@ -69,4 +69,4 @@ class Plot(object):
         Returns a base64-decoded string of the graph.
         """
         image = self.png.getvalue()
-        return base64.encodestring(image).decode('utf-8')
+        return base64.encodebytes(image).decode('utf-8')
@@ -0,0 +1,161 @@
+import logging
+
+# Default maximum number of candidate partitions examined per repartition
+MAX_NODES = 10000
+
+def repartition(subject, improvement, max_nodes=MAX_NODES):
+    """repartition
+
+    Divides the VMs of two hypervisors between them so that their combined
+    (absolute) score is as low as possible. Returns the list of VMs which should
+    be hosted on the `subject`; all other VMs should be hosted on the
+    `improvement`. Returns None if the VMs cannot be divided so that they fit on
+    both hypervisors.
+
+    VMs with the same amount of RAM and VCPUs are interchangeable, so the VMs
+    are grouped by size and only the number of VMs of every size on the subject
+    is searched for. The subject is first filled greedily with the size which
+    gives it the best score, after which the partition is refined by moving or
+    swapping single VMs between the hypervisors as long as that lowers the
+    combined score. The refinement is also started from the current partition
+    and the best result is used.
+
+    At most `max_nodes` candidate partitions are examined: half of them by the
+    greedy fill and the refinement of its result, the other half by the
+    refinement of the current partition. Both stop with the best partition found
+    so far when their share is used up, so apart from grouping and sorting the
+    VMs (O(V log V)), the cost of a pair is bounded by `max_nodes`.
+    """
+    groups = {}
+    for hypervisor in (subject, improvement):
+        for vm in hypervisor.servers:
+            sizes = groups.setdefault((vm.ram, vm.vcpus), ([], []))
+            sizes[hypervisor is improvement].append(vm)
+    sizes = sorted(groups, reverse=True)
+    totals = {size: len(groups[size][0]) + len(groups[size][1])
+              for size in sizes}
+    total_ram = sum(ram * totals[ram, vcpus] for ram, vcpus in sizes)
+    total_vcpus = sum(vcpus * totals[ram, vcpus] for ram, vcpus in sizes)
+
+    def _combined_score(ram, vcpus):
+        if ram > subject.ram_capacity or \
+                vcpus > subject.vcpus_capacity or \
+                total_ram - ram > improvement.ram_capacity or \
+                total_vcpus - vcpus > improvement.vcpus_capacity:
+            return None
+        return abs(subject.calculate_score(ram, vcpus)) + \
+            abs(improvement.calculate_score(total_ram - ram,
+                                            total_vcpus - vcpus))
+
+    current = {size: len(groups[size][0]) for size in sizes}
+    filled, nodes = _fill(subject, sizes, totals, max_nodes // 2)
+    results = [_refine(filled, sizes, totals, _combined_score,
+                       max_nodes // 2 - nodes),
+               _refine(current, sizes, totals, _combined_score,
+                       max_nodes - max_nodes // 2)]
+    results = [(score, sum(abs(counts[size] - current[size])
+                           for size in sizes), counts)
+               for score, counts in results if score is not None]
+    if not results:
+        return None
+
+    score, moves, counts = min(results, key=lambda result: result[:2])
+    logging.debug('Repartitioned with score %f and %i moves', score, moves)
+    vms = []
+    for size in sizes:
+        vms.extend((groups[size][0] + groups[size][1])[:counts[size]])
+    return vms
+
+def _usage(counts):
+    """_usage
+
+    Returns a tuple containing the RAM and VCPUs used by the given number of VMs
+    of every size.
+    """
+    return (sum(ram * count for (ram, _), count in counts.items()),
+            sum(vcpus * count for (_, vcpus), count in counts.items()))
+
+def _fill(subject, sizes, totals, max_nodes):
+    """_fill
+
+    Fills the subject greedily: as long as a VM fits, adds the size which gives
+    the subject the best score. Stops early when `max_nodes` candidates have
+    been examined. Returns a tuple containing the number of VMs of every size
+    and the number of examined candidates.
+    """
+    counts = dict.fromkeys(sizes, 0)
+    ram = vcpus = 0
+    nodes = 0
+    candidates = list(sizes)
+    while candidates:
+        # Sizes which are used up or do not fit anymore never will again
+        candidates = [size for size in candidates
+                      if counts[size] < totals[size] and
+                      ram + size[0] <= subject.ram_capacity and
+                      vcpus + size[1] <= subject.vcpus_capacity]
+        best = None
+        best_score = None
+        for size in candidates:
+            if nodes >= max_nodes:
+                break
+            nodes += 1
+            score = abs(subject.calculate_score(ram + size[0],
+                                                vcpus + size[1]))
+            if best is None or score < best_score:
+                best = size
+                best_score = score
+        if best is None:
+            break
+        counts[best] += 1
+        ram += best[0]
+        vcpus += best[1]
+    return counts, nodes
+
+def _refine(counts, sizes, totals, combined_score, max_nodes):
+    """_refine
+
+    Improves a partition by moving a VM of a certain size from the subject to
+    the improvement or vice versa, or by swapping two VMs of different sizes,
+    until no move lowers the combined score or `max_nodes` candidates have been
+    examined; a sweep which is cut short still applies the best move it found.
+    Returns a tuple containing the combined score (None if the VMs do not fit)
+    and the number of VMs of every size.
+    """
+    counts = dict(counts)
+    ram, vcpus = _usage(counts)
+    score = combined_score(ram, vcpus)
+    options = [None] + sizes
+    nodes = 0
+    while nodes < max_nodes:
+        best = None
+        for removed in options:
+            if nodes >= max_nodes:
+                break
+            nodes += 1
+            if removed is not None and not counts[removed]:
+                continue
+            for added in options:
+                if nodes >= max_nodes:
+                    break
+                nodes += 1
+                if added == removed or \
+                        added is not None and counts[added] == totals[added]:
+                    continue
+                new_ram = ram - (removed[0] if removed else 0) + \
+                    (added[0] if added else 0)
+                new_vcpus = vcpus - (removed[1] if removed else 0) + \
+                    (added[1] if added else 0)
+                new_score = combined_score(new_ram, new_vcpus)
+                if new_score is None or \
+                        score is not None and new_score >= score or \
+                        best is not None and new_score >= best[0]:
+                    continue
+                best = (new_score, removed, added, new_ram, new_vcpus)
+        if best is None:
+            break
+        score, removed, added, ram, vcpus = best
+        if removed:
+            counts[removed] -= 1
+        if added:
+            counts[added] += 1
+    return score, counts
@@ -1,18 +1,52 @@
 import logging
 from math import atan, sqrt, sin
-from novaclient.v2.servers import Server
 from sobchak.helper import get_object_by_id
 
-class CustomServer(Server):
+class CustomServer(object):
     """CustomServer
 
     A CustomServer object contains information about an OpenStack instance and
-    the resources it needs.
+    the resources it needs. Only the fields the optimizer needs are copied from
+    the API resource, so the (much larger) resource itself can be discarded.
+
+    As flavor resources never change, the geometry of the VM's resource vector
+    is calculated once and stored in plain attributes:
+
+    * `ratio`: the RAM/vCPU ratio, rounded down to the nearest integer to allow
+      ratio comparison as it prevents floating point comparison issues
+    * `length`: the length of the resource vector
+    * `angle`: the angle of the resource vector (based on `ratio`)
+    * `divergence`: the divergence from the slope in `reference` (see
+      `calculate_divergence`)
     """
 
+    __slots__ = ('id', 'name', 'status', 'hypervisor', 'flavor_id', 'ram',
+                 'vcpus', 'ratio', 'length', 'angle', 'reference',
+                 'divergence')
+
     def __init__(self, server, flavors):
-        Server.__init__(self, server.manager, server._info)
-        self._flavor = get_object_by_id(flavors, self.flavor['id'])
+        info = server._info
+        self.id = info['id']
+        self.name = info['name']
+        self.status = info['status']
+        self.hypervisor = info.get('OS-EXT-SRV-ATTR:hypervisor_hostname')
+        flavor = info['flavor']
+        self.flavor_id = flavor.get('id')
+        if 'ram' in flavor and 'vcpus' in flavor:
+            # Since Nova API microversion 2.47 the flavor is embedded
+            self.ram = flavor['ram']
+            self.vcpus = flavor['vcpus']
+        else:
+            flavor = get_object_by_id(flavors, self.flavor_id)
+            if not flavor:
+                raise LookupError('unknown flavor {}'.format(self.flavor_id))
+            self.ram = flavor.ram
+            self.vcpus = flavor.vcpus
+        self.ratio = int(self.ram/self.vcpus)
+        self.length = sqrt(self.ram * self.ram + self.vcpus * self.vcpus)
+        self.angle = atan(self.ratio)
+        self.reference = None
+        self.divergence = None
         logging.debug('Initialized server: %s', self.id)
 
     def __str__(self):
@@ -24,46 +58,8 @@ class CustomServer(Server):
     def __eq__(self, other):
         return self.id == other.id
 
-    @property
-    def ram(self):
-        """ram
-
-        Returns the memory which is assigned to this server in MB's.
-        """
-        return self._flavor.ram
-
-    @property
-    def vcpus(self):
-        """vcpus
-
-        Returns the number of virtual CPU's which are assigned to this server.
-        """
-        return self._flavor.vcpus
-
-    @property
-    def ratio(self):
-        """ratio
-
-        Returns the RAM/vCPU ratio, rounded down to the nearest integer to allow
-        ratio comparison as it prevents floating point comparison issues.
-        """
-        return int(self.ram/self.vcpus)
-
-    @property
-    def hypervisor(self):
-        """hypervisor
-
-        Returns the hypervisor hostname.
-        """
-        return self.__getattr__('OS-EXT-SRV-ATTR:hypervisor_hostname')
-
-    @property
-    def length(self):
-        """length
-
-        Returns the length of this VM's resource vector.
-        """
-        return sqrt(self.ram * self.ram + self.vcpus * self.vcpus)
+    def __hash__(self):
+        return hash(self.id)
 
     @property
     def active(self):
@@ -77,10 +73,13 @@ class CustomServer(Server):
         """calculate_divergence
 
         Returns the divergence from a reference slope. See README.md for more
-        information about what this actually means.
+        information about what this actually means. The result is stored in
+        `divergence`, so it is only calculated again for another reference.
         """
-        angle = atan(self.ratio) - atan(reference)
-        return self.length * sin(angle)
+        if reference != self.reference:
+            self.reference = reference
+            self.divergence = self.length * sin(self.angle - atan(reference))
+        return self.divergence
 
     def to_dict(self):
         """to_dict
@@ -1,5 +1,7 @@
 import os
 import logging
+import requests
+from novaclient import api_versions
 from novaclient import client as nova_client
 from keystoneauth1 import session as keystone_session
 from keystoneclient.v3 import client as keystone_client
@@ -15,20 +17,54 @@ except KeyError:
     logging.error('Please source your OpenStack openrc file.')
     raise
 
+# Nova API microversion which embeds the flavor's resources in server details
+EMBEDDED_FLAVOR_VERSION = '2.47'
+
 class Session(keystone_session.Session):
     """Session
 
     Maintains an OpenStack Keystone session and provides a Keystone and a Nova
-    client.
+    client. The underlying HTTP connections are kept alive and pooled, so up to
+    `pool_size` requests can be done in parallel.
     """
 
-    def __init__(self):
+    def __init__(self, pool_size=10):
         auth = v3.Password(
             auth_url=AUTH_URL,
             username=USERNAME,
             password=PASSWORD,
             project_id=PROJECT_ID,
             user_domain_name='Default')
-        keystone_session.Session.__init__(self, auth=auth)
+        http_session = requests.Session()
+        for scheme in ['https://', 'http://']:
+            http_session.mount(scheme, keystone_session.TCPKeepAliveAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size))
+        keystone_session.Session.__init__(self, auth=auth,
+                                          session=http_session)
         self.keystone_client = keystone_client.Client(session=self)
-        self.nova_client = nova_client.Client('2', session=self)
+        self.nova_client = self._negotiate_nova_client()
+
+    def _negotiate_nova_client(self):
+        """_negotiate_nova_client
+
+        Returns a Nova client which uses the microversion that embeds flavor
+        resources in server details if the API supports it, otherwise returns a
+        client using the base version.
+        """
+        client = nova_client.Client('2', session=self)
+        wanted_version = api_versions.APIVersion(EMBEDDED_FLAVOR_VERSION)
+        try:
+            current = client.versions.get_current()
+            max_version = api_versions.APIVersion(current.version)
+            min_version = api_versions.APIVersion(current.min_version)
+        except Exception as e:
+            logging.warning('Could not determine Nova API versions: %s', e)
+            return client
+
+        if not wanted_version.matches(min_version, max_version):
+            logging.info('Nova API microversion %s is not supported',
+                         EMBEDDED_FLAVOR_VERSION)
+            return client
+
+        logging.info('Using Nova API microversion %s', EMBEDDED_FLAVOR_VERSION)
+        return nova_client.Client(EMBEDDED_FLAVOR_VERSION, session=self)